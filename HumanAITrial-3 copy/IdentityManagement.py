@@ -1,15 +1,10 @@
-import numpy as np
-from joblib import dump, load
-from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import dump
 import pandas as pd
-from sklearn.metrics import pairwise_distances
 
-from preprocessing import lemmatisation, tokenisation,name_error
+from preprocessing import lemmatisation_full, tokenisation,name_error, get_stop_words
+from turn_analysis import analyse
 import random
 
-name=""   #this is the current extracted name
-pname="" #previous extracted name
 set_response = ['[name] is such a pretty name',
                 'I will now call you [name]',
                 '[name] is such a cool name',
@@ -29,10 +24,13 @@ get_response = ["Let me remember, your name is",
                 "You like to be called"]
 
 data_path = 'Datasets/IdentityManagement.csv'
+model_path = 'models/identity_model.joblib'
+model_config = {'preprocessing': 'lemmatisation_full', 'columns': ('phrase', 'type')}  #used by the build cache
 
 def extract_name(user_query):
     tokens = tokenisation(user_query)
-    relevant_words = [word for word in tokens if word.isalpha() and word.lower() not in stopwords.words('english')]
+    stop_words = get_stop_words()
+    relevant_words = [word for word in tokens if word.isalpha() and word.lower() not in stop_words]
 
     if relevant_words:
         return relevant_words[-1].capitalize()  # Return the last word
@@ -41,65 +39,59 @@ def extract_name(user_query):
 
 
 
-# Create and save the identity management model
+# Create and save the lemmatised identity phrases and their types for the fused index
 
 def create_identity_model():
     df = pd.read_csv(data_path)
-    df['question'] = df['phrase'].apply(lemmatisation)
-    question_type = df['type']
+    phrases = df['phrase'].apply(lemmatisation_full)
+    dump((list(phrases), list(df['type'])), model_path)
 
-    tfidf_vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 4))
-    transform = tfidf_vectorizer.fit_transform(df['question']).toarray()
 
-    # Save the vectorizer and transformed data
-    dump((tfidf_vectorizer, transform,question_type), 'models/identity_model.joblib')
+THRESHOLD = 0.5
 
 
-# Load the saved identity model
-def load_identity_model():
-    identity_vectorizer, identity_transform,question_type = load('models/identity_model.joblib')
-    return identity_vectorizer, identity_transform,question_type
-
-
-#handle identity management
-def identity_management(query):
-    global name
-    identity_vectorizer, identity_transform,question_type = load_identity_model()
-
-    processed_query = lemmatisation(query)
-    query_transform = identity_vectorizer.transform([processed_query]).toarray()
-
-    cos_sim = 1 - pairwise_distances(query_transform, identity_transform, metric='cosine').flatten()
-
-    max_sim = cos_sim.max()
-    matching_indices = np.where(cos_sim == max_sim)[0]
-
+def identity_reply(query, max_sim, matching_indices, question_type, current_name):
+    """
+    Work out the reply to a name management query.
+    Returns the response and the name that should be remembered afterwards.
+    """
     if len(query.strip().split()) == 1 and query.strip().isalpha():
-        name = query.strip()
-        return random.choice(set_response).replace("[name]", name)
-
-    THRESHOLD = 0.5
+        new_name = query.strip()
+        return random.choice(set_response).replace("[name]", new_name), new_name
 
     if max_sim >= THRESHOLD:
         # Get the intent type for the matched phrase
 
-        matched_type = question_type.iloc[matching_indices[0]]  # Extract the first matching type
+        matched_type = question_type[matching_indices[0]]  # Extract the first matching type
 
         # Choose appropriate response based on intent type
         if matched_type == 'set': #set the name
-            name=extract_name(query)
-            return random.choice(set_response).replace("[name]", name)
+            new_name=extract_name(query)
+            return random.choice(set_response).replace("[name]", new_name), new_name
         elif matched_type == 'get': #retrieve the name
-            if name=="":
-                return "I do not know your name yet. What is your name?"
-            return random.choice(get_response) + " " + name
+            if current_name=="":
+                return "I do not know your name yet. What is your name?", current_name
+            return random.choice(get_response) + " " + current_name, current_name
         elif matched_type == 'change': #change the name
-            pname=name
-            name= extract_name(query)
-            return random.choice(change_response).replace("[name]", name).replace("[pname]", pname)
+            new_name= extract_name(query)
+            return random.choice(change_response).replace("[name]", new_name).replace("[pname]", current_name), new_name
+        return None, current_name
     else:
         # Return an error message if no matching phrase meets the threshold
-        return random.choice(name_error)
+        return random.choice(name_error), current_name
+
+
+#handle identity management, the name is remembered in the session
+def identity_management(query, session, analysis=None):
+    max_sim, matching_indices, question_type = analyse(query, analysis).match('name_management')
+
+    response, new_name = identity_reply(query, max_sim, matching_indices, question_type, session.name)
+    if new_name != session.name:
+        session.pname = session.name
+        session.name = new_name
+    return response
 
 
-    #return "Response based on identity management model"
+def identity_from_match(query, max_sim, matching_indices, question_type):
+    #replies as if no name had been given yet and without remembering any name
+    return identity_reply(query, max_sim, matching_indices, question_type, "")[0]
@@ -1,50 +1,61 @@
+import os
 import random
 
-import numpy as np
-from joblib import dump, load
-from nltk import word_tokenize
-from nltk.corpus import stopwords
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import dump
 import pandas as pd
-from sklearn.metrics import pairwise_distances
 
-from preprocessing import lemmatisation_q, error_message
+from corpus_store import write_streamed_corpus
+from preprocessing import lemmatisation_full, error_message
+from turn_analysis import analyse
+from model_registry import registry
 
 data_path = 'Datasets/COMP3074-CW1-Dataset.csv'
+model_path = 'models/question_model.joblib'
+corpus_prefix = 'models/question_corpus'  #files of the streamed corpus
+#set CHATBOT_QA_STREAMING=1 for a dataset too large to load at once, it is then read and lemmatised a chunk
+#at a time and the answers stay on disk
+streaming = os.environ.get('CHATBOT_QA_STREAMING', '') == '1'
+chunk_size = 10000  #rows of the dataset read at a time when streaming
+model_config = {'preprocessing': 'lemmatisation_full', 'columns': ('Question', 'Answer'),
+                'streaming': streaming}  #used by the build cache
 THRESHOLD=0.4
-df = pd.read_csv(data_path)
 
-# creates and saves the question answering model
+# creates and saves the lemmatised questions and their answers for the fused index
 
-def create_question_model():
-    df['question'] = df['Question'].apply(lemmatisation_q)
-    tfidf_vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 4))
-    transform = tfidf_vectorizer.fit_transform(df['question']).toarray()
-    # Save the vectorizer and transformed data
-    dump((tfidf_vectorizer, transform), 'models/question_model.joblib')
-
-
-# Load the saved question answering model
-def load_question_model():
-    question_vectorizer, question_transform = load('models/question_model.joblib')
+def question_chunks():
+    #yields (lemmatised questions, answers) for every chunk of the dataset, the questions are lemmatised as they are written
+    for chunk in pd.read_csv(data_path, usecols=['Question', 'Answer'], chunksize=chunk_size):
+        yield map(lemmatisation_full, chunk['Question']), chunk['Answer']
 
-    return question_vectorizer, question_transform
-
-
-# function to handle question answering
-def QuestionAnwering(query):
-    question_vectorizer, question_transform = load_question_model()
 
-    processed_query = lemmatisation_q(query)
-    query_transform = question_vectorizer.transform([processed_query]).toarray()
-
-    cos_sim = 1 - pairwise_distances(query_transform, question_transform, metric='cosine').flatten()
+def create_question_model():
+    if streaming:
+        dump(write_streamed_corpus(question_chunks(), corpus_prefix), model_path)
+        return
+    df = pd.read_csv(data_path)
+    questions = df['Question'].apply(lemmatisation_full)
+    dump((list(questions), list(df['Answer'])), model_path)
 
-    max_sim = cos_sim.max()
-    matching_indices = np.where(cos_sim == max_sim)[0]
 
+def answer_from_match(max_sim, matching_indices, answers): #chooses the answer for the best matching questions
     if max_sim >= THRESHOLD:
         rand_index = random.choice(matching_indices)
-        return df['Answer'].iloc[rand_index]
+        return answers[rand_index]
     else:
         return random.choice(error_message)
+
+
+# function to handle question answering
+def QuestionAnwering(query, analysis=None):
+    max_sim, matching_indices, answers = analyse(query, analysis).match('question_answering')
+    return answer_from_match(max_sim, matching_indices, answers)
+
+
+def top_answers(query, k=5, analysis=None):
+    #the k best answers and the similarity of their questions, with any tied with the k-th
+    #only questions sharing a word are scored
+    fused_index = registry.get('fused')
+    rows, scores = fused_index.top_rows(analyse(query, analysis).lemmas, k, 'question_answering')
+    start, _ = fused_index.slices['question_answering']
+    answers = fused_index.payloads['question_answering']
+    return [(answers[row - start], float(score)) for row, score in zip(rows, scores)]
@@ -1,12 +1,12 @@
-import numpy as np
-from joblib import dump, load
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import dump
 import pandas as pd
 import random
-from preprocessing import lemmatisation
-from sklearn.metrics import pairwise_distances
+from preprocessing import lemmatisation_full
+from turn_analysis import analyse
 
 data_path = 'Datasets/smallTalk.csv'
+model_path = 'models/smalltalk_model.joblib'
+model_config = {'preprocessing': 'lemmatisation_full', 'columns': ('phrase', 'Response')}  #used by the build cache
 error_message = [
     "Sorry, I don't have an answer for that.",
     "sorry I can't understand. Type 'help' to know what I can do."
@@ -18,39 +18,22 @@ error_message = [
 ]
 
 THRESHOLD = 0.5
-df = pd.read_csv(data_path)
 
-# Create and save the small talk model
+# Create and save the lemmatised small talk phrases and their responses for the fused index
 
 def create_smalltalk_model():
     df = pd.read_csv(data_path)
-    df['question'] = df['phrase'].apply(lemmatisation)
-
-    tfidf_vectorizer = TfidfVectorizer(analyzer='word')
-    transform = tfidf_vectorizer.fit_transform(df['question']).toarray()
-
-    # Save the vectorizer and transformed data
-    dump((tfidf_vectorizer, transform), 'models/smalltalk_model.joblib')
-
-# Load the saved small talk model
-def load_smalltalk_model():
-    smalltalk_vectorizer, smalltalk_transform = load('models/smalltalk_model.joblib')
-    return smalltalk_vectorizer, smalltalk_transform
-
-# Function to handle small talk response
-def talk_response(query):
-    smalltalk_vectorizer, smalltalk_transform = load_smalltalk_model()
-
-    processed_query = lemmatisation(query)
-    query_transform = smalltalk_vectorizer.transform([processed_query]).toarray()
-
-    cos_sim = 1 - pairwise_distances(query_transform, smalltalk_transform, metric='cosine').flatten()
-
-    max_sim = cos_sim.max()
-    matching_indices = np.where(cos_sim == max_sim)[0]
+    phrases = df['phrase'].apply(lemmatisation_full)
+    dump((list(phrases), list(df['Response'])), model_path)
 
+def talk_from_match(max_sim, matching_indices, responses): #chooses the response for the best matching phrases
     if max_sim >= THRESHOLD:
         rand_index = random.choice(matching_indices)
-        return df['Response'].iloc[rand_index]
+        return responses[rand_index]
     else:
         return random.choice(error_message)
+
+# Function to handle small talk response
+def talk_response(query, analysis=None):
+    max_sim, matching_indices, responses = analyse(query, analysis).match('small_talk')
+    return talk_from_match(max_sim, matching_indices, responses)
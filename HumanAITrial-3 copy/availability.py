@@ -0,0 +1,231 @@
+import threading
+import time
+from datetime import date, datetime
+
+from booking_journal import booking_journal
+from booking_store import booking_store
+
+#capacity model behind the availability answers of the booking flow
+#the day is cut into slots. A booking keeps its tables for every slot of its sitting and its guests count
+#against the covers that can arrive in the slot it starts in. A day is read from the database once into
+#per slot occupancy counts, which bookings made, moved or cancelled through this process then update in
+#place, so checking a time is a few list lookups instead of a query. The counts of one process miss what other
+#processes book until the day is read again, so every write is checked once more in its database transaction
+
+opening_time = '11:00'
+closing_time = '23:00'  #last time a booking can start
+slot_minutes = 15
+sitting_minutes = 90  #how long a booking keeps its tables
+covers_per_slot = 30  #guests that can arrive in one slot
+tables = {2: 10, 4: 10, 6: 4, 10: 3}  #seats at a table -> number of tables of that size
+suggestion_count = 3  #free times offered when the asked one is full
+refresh_interval = 60  #seconds before a day is read again, to see bookings made by other processes
+
+table_sizes = sorted(tables)
+opening_minute = int(opening_time[:2]) * 60 + int(opening_time[3:])
+start_slots = (int(closing_time[:2]) * 60 + int(closing_time[3:]) - opening_minute) // slot_minutes + 1
+sitting_slots = -(-sitting_minutes // slot_minutes)
+day_slots = start_slots + sitting_slots - 1  #a sitting starting at closing time runs past it
+
+
+def slot_of(booking_time):  #index of the slot a time falls in, may be outside the day
+    return (booking_time.hour * 60 + booking_time.minute - opening_minute) // slot_minutes
+
+
+def time_of(slot):
+    minutes = opening_minute + slot * slot_minutes
+    return datetime(2000, 1, 1, minutes // 60, minutes % 60).time()
+
+
+def table_options(people):
+    #(size index, tables) that could seat the party, smallest table first
+    #parties bigger than every table join tables of the largest size
+    options = [(index, 1) for index, size in enumerate(table_sizes) if size >= people]
+    return options or [(len(table_sizes) - 1, -(-people // table_sizes[-1]))]
+
+
+class DayOccupancy:
+    def __init__(self):
+        self.in_use = [[0] * len(table_sizes) for _ in range(day_slots)]  #tables of each size taken per slot
+        self.arrivals = [0] * start_slots  #guests arriving per slot
+        self.allocations = {}  #booking id -> (slot, size index, tables, people)
+        self.loaded_at = time.monotonic()
+
+    def allocation_for(self, slot, people):  #(size index, tables) free for the party, None if there is none
+        if not 0 <= slot < start_slots or self.arrivals[slot] + people > covers_per_slot:
+            return None
+        for size_index, count in table_options(people):
+            limit = tables[table_sizes[size_index]] - count
+            if all(self.in_use[s][size_index] <= limit for s in range(slot, slot + sitting_slots)):
+                return size_index, count
+        return None
+
+    def add(self, booking_id, slot, people, allocation):
+        size_index, count = allocation
+        for s in range(slot, slot + sitting_slots):
+            self.in_use[s][size_index] += count
+        self.arrivals[slot] += people
+        self.allocations[booking_id] = (slot, size_index, count, people)
+
+    def remove(self, booking_id):  #frees the tables of the booking, returns its allocation or None
+        allocation = self.allocations.pop(booking_id, None)
+        if allocation is not None:
+            slot, size_index, count, people = allocation
+            for s in range(slot, slot + sitting_slots):
+                self.in_use[s][size_index] -= count
+            self.arrivals[slot] -= people
+        return allocation
+
+    def rename(self, old_id, new_id):
+        if new_id in self.allocations:  #the day was read again and already counts the booking
+            self.remove(old_id)
+        elif old_id in self.allocations:
+            self.allocations[new_id] = self.allocations.pop(old_id)
+
+    def restore(self, booking_id, allocation):  #puts back an allocation taken by remove
+        slot, size_index, count, people = allocation
+        self.add(booking_id, slot, people, (size_index, count))
+
+
+class Availability:
+    """
+    Free tables per day and slot for this process, shared by every session.
+    Days are loaded on first use and read again after refresh_interval. In between, bookings saved, moved
+    or cancelled here update the counts in place.
+    """
+    def __init__(self, store=None, journal=None):
+        self.store = store or booking_store
+        self.journal = journal or (None if store else booking_journal)
+        self.days = {}  #date -> DayOccupancy
+        self.lock = threading.Lock()
+        if self.journal:
+            self.journal.listeners.append(self.saved)
+
+    def read_day(self, booking_date, bookings_on_date):
+        #the occupancy of the bookings bookings_on_date reads for the date, with those journaled but not written
+        occupancy = DayOccupancy()
+        day_text = booking_date.strftime('%Y-%m-%d')
+        #bookings journaled but not written yet count too, read first so none is missed in between
+        pending = self.journal.pending_on(day_text) if self.journal else []
+        rows = bookings_on_date(day_text)
+        written = {journal_id for _, _, _, journal_id in rows}
+        bookings = [(booking_id, booking_time, people) for booking_id, booking_time, people, _ in rows]
+        bookings += [booking for booking in pending if booking[0] not in written]
+        for booking_id, booking_time, people in bookings:
+            slot = slot_of(datetime.strptime(booking_time, '%H:%M').time())
+            if 0 <= slot < start_slots:
+                #bookings made before the capacity model may overbook, they are counted as they are
+                occupancy.add(booking_id, slot, people, table_options(people)[0])
+        return occupancy
+
+    def day(self, booking_date):  #the occupancy of the date, called with the lock held
+        occupancy = self.days.get(booking_date)
+        if occupancy is None or time.monotonic() - occupancy.loaded_at > refresh_interval:
+            occupancy = self.read_day(booking_date, self.store.bookings_on_date)
+            today = date.today()
+            for old_date in [day for day in self.days if day < today]:
+                del self.days[old_date]
+            self.days[booking_date] = occupancy
+        return occupancy
+
+    def is_available(self, booking_date, booking_time, people, booking_id=None):
+        #booking_id is a booking being moved, its own tables count as free
+        with self.lock:
+            occupancy = self.day(booking_date)
+            moved = occupancy.remove(booking_id)
+            free = occupancy.allocation_for(slot_of(booking_time), people) is not None
+            if moved is not None:
+                occupancy.restore(booking_id, moved)
+        return free
+
+    def nearest_free(self, booking_date, booking_time, people, booking_id=None, count=suggestion_count):
+        #the free start times closest to the asked one, in time order
+        slot = slot_of(booking_time)
+        found = []
+        with self.lock:
+            occupancy = self.day(booking_date)
+            moved = occupancy.remove(booking_id)
+            for distance in range(1, start_slots):
+                for candidate in (slot - distance, slot + distance):
+                    if occupancy.allocation_for(candidate, people) is not None:
+                        found.append(time_of(candidate))
+                if len(found) >= count:
+                    break
+            if moved is not None:
+                occupancy.restore(booking_id, moved)
+        return sorted(found[:count])
+
+    def has_free_slot(self, booking_date, people=1):
+        with self.lock:
+            occupancy = self.day(booking_date)
+            return any(occupancy.allocation_for(slot, people) is not None for slot in range(start_slots))
+
+    def book(self, booking_id, booking_date, booking_time, people):
+        #takes tables for the booking, False if the slot is full
+        with self.lock:
+            occupancy = self.day(booking_date)
+            slot = slot_of(booking_time)
+            allocation = occupancy.allocation_for(slot, people)
+            if allocation is None:
+                return False
+            occupancy.add(booking_id, slot, people, allocation)
+            return True
+
+    def rename(self, old_id, new_id, booking_date):  #gives a reservation the id of the saved booking
+        with self.lock:
+            self.day(booking_date).rename(old_id, new_id)
+
+    def saved(self, bookings):
+        #journaled bookings now in the database are known by their booking id, so they can be moved or cancelled
+        with self.lock:
+            for journal_id, booking_id, booking_date in bookings:
+                occupancy = self.days.get(datetime.strptime(booking_date, '%Y-%m-%d').date())
+                if occupancy is not None:  #a day not loaded reads the booking from the database
+                    occupancy.rename(journal_id, booking_id)
+
+    def move(self, booking_id, old_date, new_date, new_time, new_people):
+        #moves the booking's tables, False and nothing changed if the new slot is full
+        with self.lock:
+            old_day = self.day(old_date)
+            moved = old_day.remove(booking_id)
+            new_day = self.day(new_date)
+            slot = slot_of(new_time)
+            allocation = new_day.allocation_for(slot, new_people)
+            if allocation is None:
+                if moved is not None:
+                    old_day.restore(booking_id, moved)
+                return False
+            new_day.add(booking_id, slot, new_people, allocation)
+            return True
+
+    def fits(self, booking_date, booking_time, people, booking_id=None):
+        """
+        The check booking_store makes in the transaction that writes a booking, or moves booking_id.
+        The counts above belong to this process and are read again only every refresh_interval, so another
+        process may have taken the tables since. The check counts the bookings in the database again.
+        """
+        def check(bookings_on_date):
+            occupancy = self.read_day(booking_date, bookings_on_date)
+            occupancy.remove(booking_id)
+            return occupancy.allocation_for(slot_of(booking_time), people) is not None
+        return check
+
+    def forget(self, booking_date=None):
+        #drops a loaded day, or every one, for bookings written without going through this model
+        with self.lock:
+            if booking_date is None:
+                self.days.clear()
+            else:
+                self.days.pop(booking_date, None)
+
+    def cancel(self, booking_id, booking_date):
+        with self.lock:
+            self.day(booking_date).remove(booking_id)
+
+
+def parse_booking(booking_date, booking_time):  #date and time objects of a booking row's text columns
+    return (datetime.strptime(booking_date, '%Y-%m-%d').date(),
+            datetime.strptime(booking_time, '%H:%M').time())
+
+
+table_availability = Availability()  #shared by every session of the process
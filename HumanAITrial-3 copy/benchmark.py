@@ -0,0 +1,215 @@
+import argparse
+import atexit
+import builtins
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, time as booking_time, timedelta
+
+#benchmark of scripted conversations, run from this directory
+#  python benchmark.py                  compare with benchmark_baseline.json, exits with 1 on a regression
+#  python benchmark.py --save-baseline  store this run as the baseline
+#every conversation goes through chat_turn, so intent detection, handle_response and restaurant_response are
+#timed as a user meets them. Bookings go to a throwaway database so the real one is never touched
+#the timings depend on the machine, so run --save-baseline on the machine that compares before relying on it.
+#the baseline in the repository was measured on the machine named in it
+
+work_dir = tempfile.mkdtemp(prefix='chatbot-benchmark-')
+os.environ['CHATBOT_DB_PATH'] = os.path.join(work_dir, 'bookings.db')
+os.environ['CHATBOT_JOURNAL_PATH'] = os.path.join(work_dir, 'bookings.journal')
+atexit.register(shutil.rmtree, work_dir, True)
+
+from instrumentation import percentile
+
+baseline_path = 'benchmark_baseline.json'
+repeats = 5  #times every conversation is run
+tolerance = 0.25  #fraction a result may be worse than the baseline before it counts as a regression
+slack_ms = 2.0  #and an absolute allowance, so sub-millisecond turns do not fail on timer noise
+percentiles = (50, 95, 99)
+
+#intent -> turns of one conversation as (message, text the reply must contain, case aside)
+#{date} is replaced by a date a week ahead, a day later on every repeat so the slots never fill up
+#a turn answered with anything else stops the run, the timings of a drifted script are not comparable
+conversations = {
+    'small_talk': [("Hello", "hi"), ("How are you?", "doing great"), ("Tell me a joke", "outstanding in his field"),
+                   ("Thank you", "happy to help")],
+    'question_answering': [("What is a dredge?", "dredg"), ("How are glacier caves formed?", "glacier cave"),
+                           ("What are stocks and bonds?", "bond"), ("How many days are there in a year?", "366 days")],
+    'name_management': [("My name is Sam", "Sam"), ("What is my name?", "Sam"), ("Call me Alex", "Alex"),
+                        ("What is my name?", "Alex")],
+    'discovery': [("What can you do?", "following functionality"), ("Help", "type 'general'"),
+                  ("general", "following functionality")],
+    'booking': [("I would like to book a table", "tell me your name"), ("Sam", "make another booking"),
+                ("yes", "what date"), ("{date}", "the time you would like"), ("19:00", "tables free at 19:00"),
+                ("4 people", "table for 4 people at 19:00"), ("none", "booking has been saved")],
+    'one_message_booking': [("My name is Sam", "Sam"),
+                            ("I want to book a table for 4 people at 19:00 on {date}, vegan",
+                             "booking has been saved")],
+    'modify': [("I want to change my booking", "tell me your name"), ("Sam", "your bookings"),
+               ("1", "what would you like to modify"), ("time", "new time"), ("20:00", "booking updated")],
+    'cancel': [("Cancel my booking", "tell me your name"), ("Sam", "your bookings"), ("1", "are you sure"),
+               ("yes", "cancelled successfully")]
+}
+#intents whose conversation starts with bookings for Sam, to pick from or to be told about
+seeded = {'booking', 'modify', 'cancel'}
+
+
+def no_input(prompt=''):
+    raise RuntimeError(f"a handler asked for interactive input ({prompt!r}), turns must not block")
+
+
+def seed_bookings(customer_name, booking_date):
+    from restaurantBooking import BookingManager
+    for hour in (13, 18):
+        manager = BookingManager()
+        manager.data.update(name=customer_name, date=booking_date, time=booking_time(hour), people=2,
+                            dietary='none')
+        manager.confirm_booking()
+
+
+def run_conversations():
+    """
+    Run every conversation `repeats` times, each in a new session.
+    Returns (intent -> list of turn seconds, total turns, total seconds).
+    """
+    from main import chat_turn, start_conversation
+    from preprocessing import clear_lemma_cache
+    from session import Session
+
+    latencies = {intent: [] for intent in conversations}
+    turns, total = 0, 0.0
+    for repeat in range(repeats):
+        clear_lemma_cache()  #every repeat sends the same messages, they are analysed again rather than looked up
+        booking_date = date.today() + timedelta(days=7 + repeat)
+        for intent, script in conversations.items():
+            if intent in seeded:
+                seed_bookings('Sam', booking_date)
+            session = Session()
+            start_conversation(session)
+            chat_turn(session, "Benchbot")  #names the chatbot
+            for message, expected in script:
+                message = message.format(date=booking_date.strftime('%d/%m/%Y'))
+                start = time.perf_counter()
+                reply = '\n'.join(chat_turn(session, message))
+                seconds = time.perf_counter() - start
+                if expected.lower() not in reply.lower():
+                    sys.exit(f"The {intent} conversation drifted at {message!r}: expected a reply with "
+                             f"{expected!r}, got {reply!r}")
+                latencies[intent].append(seconds)
+                turns += 1
+                total += seconds
+    return latencies, turns, total
+
+
+def cold_start():
+    #seconds from a new interpreter to the answer of its first message, models already built
+    output = subprocess.run([sys.executable, __file__, '--cold-start-child'], capture_output=True, text=True,
+                            check=True, env=os.environ)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def cold_start_child():
+    start = time.perf_counter()
+    from main import chat_turn, start_conversation
+    from model_registry import registry
+    from session import Session
+    registry.load_all()
+    session = Session()
+    start_conversation(session)
+    chat_turn(session, "Benchbot")
+    chat_turn(session, "Hello")
+    print(time.perf_counter() - start)
+
+
+def measure():
+    from main import model_specs
+    from model_cache import build_models
+    from model_registry import registry
+    from nltk_resources import ensure_nltk_resources, MissingNLTKResourceError
+    try:
+        ensure_nltk_resources()
+    except MissingNLTKResourceError as e:
+        sys.exit(str(e))
+    build_models(model_specs)  #the benchmark times answering, not training
+    registry.load_all()
+    latencies, turns, total = run_conversations()
+    results = {'intents': {}, 'turns_per_second': turns / total, 'cold_start_seconds': cold_start(),
+               'machine': f"{platform.node()} {platform.machine()} Python {platform.python_version()}"}
+    for intent, seconds in latencies.items():
+        results['intents'][intent] = {f'p{q}_ms': percentile(seconds, q) * 1000 for q in percentiles}
+        results['intents'][intent]['turns'] = len(seconds)
+    return results
+
+
+def regressions(results, baseline):
+    #a message for every result worse than the baseline by more than the tolerance
+    found = []
+    for intent, stats in results['intents'].items():
+        before = baseline['intents'].get(intent)
+        if before is None:
+            continue
+        for q in percentiles:
+            key = f'p{q}_ms'
+            limit = before[key] * (1 + tolerance) + slack_ms
+            if stats[key] > limit:
+                found.append(f"{intent} {key} {stats[key]:.1f} > {limit:.1f} (baseline {before[key]:.1f})")
+    limit = baseline['turns_per_second'] / (1 + tolerance)
+    if results['turns_per_second'] < limit:
+        found.append(f"turns per second {results['turns_per_second']:.1f} < {limit:.1f}")
+    limit = baseline['cold_start_seconds'] * (1 + tolerance)
+    if results['cold_start_seconds'] > limit:
+        found.append(f"cold start {results['cold_start_seconds']:.2f}s > {limit:.2f}s")
+    return found
+
+
+def report(results):
+    lines = [f"{'intent':<20}{'turns':>7}" + ''.join(f"{f'p{q} ms':>10}" for q in percentiles)]
+    for intent, stats in results['intents'].items():
+        lines.append(f"{intent:<20}{stats['turns']:>7}" +
+                     ''.join(f"{stats[f'p{q}_ms']:>10.1f}" for q in percentiles))
+    lines.append(f"turns per second: {results['turns_per_second']:.1f}")
+    lines.append(f"cold start: {results['cold_start_seconds']:.2f}s")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark scripted conversations against a baseline")
+    arg_parser.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    arg_parser.add_argument('--baseline', default=baseline_path)
+    arg_parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    args = arg_parser.parse_args(argv)
+    builtins.input = no_input
+
+    if args.cold_start_child:
+        cold_start_child()
+        return
+
+    results = measure()
+    print(report(results))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    found = regressions(results, baseline)
+    if baseline.get('machine') != results['machine']:
+        print(f"Note: the baseline was measured on {baseline.get('machine')}, run --save-baseline here to compare "
+              f"with this machine")
+    if found:
+        print("Regressions:\n  " + '\n  '.join(found))
+        sys.exit(1)
+    print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
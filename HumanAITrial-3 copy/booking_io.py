@@ -0,0 +1,202 @@
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from datetime import datetime
+
+from availability import table_availability
+from booking_store import booking_store
+from booking_validation import check_date, check_dietary, check_people, check_time
+
+#bulk import and export of bookings as CSV or JSONL, for moving reservations from another system or
+#seeding a database for load tests
+#  python booking_io.py import bookings.csv [--report errors.csv]
+#  python booking_io.py export bookings.jsonl [--all]
+#every imported row is checked with the rules of the conversation and valid rows are written in chunks,
+#one prepared statement and one transaction per chunk. Rows that fail are listed with their line number.
+#cancelled bookings (active 0 or false, as written by export --all) are imported as cancelled
+
+import_chunk_size = 1000  #rows per transaction
+date_formats = ['%Y-%m-%d', '%d/%m/%Y']
+time_formats = ['%H:%M', '%H:%M:%S']
+active_values = {'1': 1, 'true': 1, '': 1, '0': 0, 'false': 0}  #a missing active column means active
+#column of a booking -> names it may have in an imported file
+field_names = {
+    'customer_name': ('customer_name', 'name'),
+    'booking_date': ('booking_date', 'date'),
+    'booking_time': ('booking_time', 'time'),
+    'number_of_people': ('number_of_people', 'people'),
+    'dietary': ('dietary',)
+}
+
+
+def file_format(path, given=None):
+    if given:
+        return given
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+
+
+def read_records(path, format_name):
+    #yields (line number, dict of the row or None if the line is not valid JSON)
+    with open(path, newline='', encoding='utf-8') as f:
+        if format_name == 'csv':
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    yield line_number, record if isinstance(record, dict) else None
+
+
+def parse_with(value, formats):  #the first format that parses the text, None if none does
+    for format_string in formats:
+        try:
+            return datetime.strptime(value, format_string)
+        except ValueError:
+            pass
+    return None
+
+
+def validate_record(record, today=None):
+    """
+    Check one imported row with the booking rules.
+    Returns ((name, date, time, people, dietary, active) ready to insert, None) or (None, list of problems).
+    """
+    if record is None:
+        return None, ["not a JSON object"]
+    active = active_values.get(str(record.get('active', 1)).strip().lower())
+    if active is None:
+        return None, [f"active {record['active']!r} is not 0, 1, true or false"]
+    values = {}
+    for field, names in field_names.items():
+        value = next((record[name] for name in names if record.get(name) not in (None, '')), None)
+        values[field] = str(value).strip() if value is not None else None
+    problems = [f"missing {field}" for field, value in values.items() if not value]
+    if problems:
+        return None, problems
+
+    booking_date = parse_with(values['booking_date'], date_formats)
+    if booking_date is None:
+        problems.append(f"date {values['booking_date']!r} is not YYYY-MM-DD or DD/MM/YYYY")
+    else:
+        problems.append(check_date(booking_date.date(), today))
+    booking_time = parse_with(values['booking_time'], time_formats)
+    if booking_time is None:
+        problems.append(f"time {values['booking_time']!r} is not HH:MM")
+    else:
+        problems.append(check_time(booking_time.time()))
+    try:
+        people = int(values['number_of_people'])
+        problems.append(check_people(people))
+    except ValueError:
+        problems.append(f"number of people {values['number_of_people']!r} is not a whole number")
+    dietary = values['dietary'].lower()
+    problems.append(check_dietary(dietary))
+
+    problems = [problem for problem in problems if problem]
+    if problems:
+        return None, problems
+    return (values['customer_name'], booking_date.strftime('%Y-%m-%d'), booking_time.strftime('%H:%M'),
+            people, dietary, active), None
+
+
+def write_chunk(store, chunk, errors):
+    #writes [(line number, row)] in one transaction, row by row if the chunk fails so the bad rows are found
+    try:
+        store.insert_bookings([row for _, row in chunk])
+        return len(chunk)
+    except sqlite3.Error:
+        written = 0
+        for line_number, row in chunk:
+            try:
+                store.insert_bookings([row])
+                written += 1
+            except sqlite3.Error as e:
+                errors.append((line_number, f"database error: {e}"))
+        return written
+
+
+def import_bookings(path, format_name=None, store=None, chunk_size=import_chunk_size):
+    """
+    Import the bookings of a CSV or JSONL file.
+    Returns (number of bookings written, [(line number, problems)] of the rows that were not).
+    """
+    store = store or booking_store
+    today = datetime.now().date()
+    written, errors, chunk = 0, [], []
+    for line_number, record in read_records(path, file_format(path, format_name)):
+        row, problems = validate_record(record, today)
+        if problems:
+            errors.append((line_number, '; '.join(problems)))
+            continue
+        chunk.append((line_number, row))
+        if len(chunk) >= chunk_size:
+            written += write_chunk(store, chunk, errors)
+            chunk = []
+    if chunk:
+        written += write_chunk(store, chunk, errors)
+    if written and store is booking_store:
+        table_availability.forget()  #the imported bookings take tables
+    errors.sort()
+    return written, errors
+
+
+def export_bookings(path, format_name=None, store=None, active_only=True):  #returns the number of bookings written
+    store = store or booking_store
+    cursor = store.export_bookings(active_only)
+    columns = [column[0] for column in cursor.description]
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if file_format(path, format_name) == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for row in cursor:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in cursor:
+                f.write(json.dumps(dict(zip(columns, row))) + '\n')
+                count += 1
+    return count
+
+
+def write_report(path, errors):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['line', 'error'])
+        writer.writerows(errors)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Import or export bookings as CSV or JSONL")
+    arg_parser.add_argument('action', choices=['import', 'export'])
+    arg_parser.add_argument('path')
+    arg_parser.add_argument('--format', choices=['csv', 'jsonl'], help="by default taken from the file extension")
+    arg_parser.add_argument('--chunk-size', type=int, default=import_chunk_size, help="rows per transaction")
+    arg_parser.add_argument('--report', help="write the rows that were not imported to this CSV file")
+    arg_parser.add_argument('--all', action='store_true', help="export cancelled bookings as well")
+    args = arg_parser.parse_args(argv)
+
+    if args.action == 'export':
+        count = export_bookings(args.path, args.format, active_only=not args.all)
+        print(f"Exported {count} bookings to {args.path}")
+        return
+
+    written, errors = import_bookings(args.path, args.format, chunk_size=args.chunk_size)
+    print(f"Imported {written} bookings, {len(errors)} rows rejected")
+    if args.report:
+        write_report(args.report, errors)
+        print(f"Rejected rows written to {args.report}")
+    else:
+        for line_number, problems in errors:
+            print(f"  line {line_number}: {problems}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
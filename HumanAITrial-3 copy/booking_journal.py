@@ -0,0 +1,213 @@
+import atexit
+import collections
+import fcntl
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from booking_store import booking_store
+
+#optional write-behind for confirmed bookings, for bursts where many users confirm at once
+#a confirmed booking is appended to a local journal file and synced to disk, then the user gets their answer
+#straight away. A background thread gathers what has been journaled and writes it to the bookings table in
+#one transaction. Every entry carries a journal id stored in a unique column, so replaying the journal after
+#a crash never writes a booking twice. Each process has its own journal file, locked while the process owns it,
+#so the next start replays the files of stopped processes and leaves those of running ones alone
+#a journaled booking is confirmed against the tables counted by its own process, not checked in the database
+#like a direct insert, so with several processes it can overbook. Set CHATBOT_WRITE_BEHIND=1 to turn it on
+
+write_behind = os.environ.get('CHATBOT_WRITE_BEHIND') == '1'
+journal_prefix = os.environ.get('CHATBOT_JOURNAL_PATH', 'restaurant_bookings.journal')
+commit_interval = 0.05  #seconds the writer waits for more bookings before a group commit
+max_batch = 500  #bookings per transaction
+retry_interval = 1.0  #seconds before a failed group commit is tried again
+close_retries = 3  #failed group commits after close before the rest is left in the file for the next start
+journal_fields = ('journal_id', 'customer_name', 'booking_date', 'booking_time', 'number_of_people', 'dietary')
+
+
+def open_locked(path):
+    #opens a journal file for appending and locks it, again if replay_journals removed it in the meantime
+    while True:
+        f = open(path, 'a', encoding='utf-8')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def journal_row(entry):  #the values of an entry in the order of the insert statement
+    return tuple(entry[field] for field in journal_fields[1:]) + (entry['journal_id'],)
+
+
+class BookingJournal:
+    """
+    Journal of confirmed bookings not yet written to the database, with the thread that writes them.
+    A process forked from one that used the journal opens its own file and starts its own writer.
+    """
+    def __init__(self, store=None, prefix=None):
+        self.store = store or booking_store
+        self.prefix = prefix or journal_prefix
+        self.pid = None
+        self.lock = threading.Lock()  #guards the file and the pending entries
+        self.written = threading.Condition(self.lock)  #notified after every group commit
+        self.sync_lock = threading.Lock()
+        self.appended = 0  #entries appended to the file and how many of them are synced
+        self.synced = 0
+        self.pending = []
+        self.pending_names = collections.Counter()
+        self.file = None
+        self.writer = None
+        self.stopping = False
+        self.listeners = []  #called with the (journal id, booking id, date) of every group commit
+
+    def new_id(self):  #a journal id, taken before append so the booking can be known by it from the start
+        return uuid.uuid4().hex
+
+    def path(self):
+        return f"{self.prefix}.{os.getpid()}"
+
+    def ensure_started(self):  #called with the lock held
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            if self.file is not None:  #the parent's file, its lock must not outlive the parent in this process
+                self.file.close()
+            self.file = open_locked(self.path())
+            self.pending, self.pending_names = [], collections.Counter()
+            self.appended = self.synced = 0
+            self.stopping = False
+            self.writer = threading.Thread(target=self.write_loop, name='booking-journal', daemon=True)
+            self.writer.start()
+
+    def append(self, customer_name, booking_date, booking_time, number_of_people, dietary, journal_id=None):
+        """
+        Journal a booking and return its journal id once it is on disk.
+        Appends of many threads share one fsync: whoever syncs first syncs everything written so far.
+        """
+        entry = dict(zip(journal_fields, (journal_id or self.new_id(), customer_name, booking_date, booking_time,
+                                          number_of_people, dietary)))
+        with self.lock:
+            self.ensure_started()
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.appended += 1
+            sequence = self.appended
+            self.pending.append(entry)
+            self.pending_names[customer_name] += 1
+            self.written.notify_all()
+            fd = self.file.fileno()
+        with self.sync_lock:
+            if self.synced < sequence:
+                target = self.appended
+                os.fsync(fd)
+                self.synced = target
+        return entry['journal_id']
+
+    def write_loop(self):
+        failures = 0
+        while True:
+            with self.lock:
+                while not self.pending and not self.stopping:
+                    self.written.wait()
+                if not self.pending:
+                    return
+            time.sleep(commit_interval)  #lets a burst of bookings gather into one transaction
+            with self.lock:
+                batch = self.pending[:max_batch]
+            try:
+                booking_ids = self.store.insert_journaled([journal_row(entry) for entry in batch])
+            except sqlite3.Error as e:  #kept in the journal and tried again
+                failures += 1
+                if self.stopping and failures >= close_retries:  #exit must not wait on the database forever
+                    print(f"Booking journal write failed, left in {self.path()} for the next start: {e}",
+                          file=sys.stderr)
+                    return
+                print(f"Booking journal write failed, retrying: {e}", file=sys.stderr)
+                time.sleep(retry_interval)
+                continue
+            failures = 0
+            #before the waiters are woken, so a booking read back from the database is found by its id
+            saved = [(entry['journal_id'], booking_ids[entry['journal_id']], entry['booking_date'])
+                     for entry in batch]
+            for listener in self.listeners:
+                try:
+                    listener(saved)
+                except Exception as e:  #the rows are written, a listener must not stop the writer
+                    print(f"Booking journal listener failed: {e!r}", file=sys.stderr)
+            with self.lock:
+                del self.pending[:len(batch)]
+                for entry in batch:
+                    self.pending_names[entry['customer_name']] -= 1
+                    if not self.pending_names[entry['customer_name']]:
+                        del self.pending_names[entry['customer_name']]
+                if not self.pending:  #everything is in the database, the journal starts again empty
+                    self.file.truncate(0)
+                self.written.notify_all()
+
+    def pending_on(self, booking_date):  #(journal id, time, people) of the bookings on a date not yet written
+        with self.lock:
+            if self.pid != os.getpid():
+                return []
+            return [(entry['journal_id'], entry['booking_time'], entry['number_of_people'])
+                    for entry in self.pending if entry['booking_date'] == booking_date]
+
+    def wait_written(self, customer_name=None, timeout=5.0):
+        #waits until the journaled bookings, or those of one customer, are in the database
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while (self.pending_names[customer_name] if customer_name else self.pending) and \
+                    self.pid == os.getpid():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.written.wait(remaining):
+                    break
+
+    def close(self):  #writes what is left and stops the writer, a file still holding bookings is kept
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.stopping = True
+            self.written.notify_all()
+        self.writer.join()
+        self.file.close()
+        if os.path.getsize(self.path()) == 0:
+            os.remove(self.path())
+        self.pid = None
+
+
+def replay_journals(store=None, prefix=None):
+    """
+    Write the bookings left in journal files by processes that stopped before writing them, then remove
+    the files. The files of processes still running are locked and skipped, their own writers save them.
+    Run it once on startup, before the server starts workers. Returns the number of entries read.
+    """
+    store = store or booking_store
+    entries = 0
+    for path in sorted(glob.glob(glob.escape(prefix or journal_prefix) + '.*')):
+        rows = []
+        with open(path, encoding='utf-8') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            for line in f:
+                try:
+                    rows.append(journal_row(json.loads(line)))
+                except (ValueError, KeyError):  #the last line of a crash may be cut short
+                    pass
+            for start in range(0, len(rows), max_batch):
+                store.insert_journaled(rows[start:start + max_batch])
+            entries += len(rows)
+            os.remove(path)  #still locked, so a process given the same pid opens a new file
+    return entries
+
+
+booking_journal = BookingJournal() if write_behind else None
+if booking_journal is not None:
+    atexit.register(booking_journal.close)
@@ -0,0 +1,273 @@
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+from instrumentation import timed
+
+#data access layer for the bookings database
+#every thread keeps one long lived connection, opened the first time it is needed, so a query costs no
+#connect and the statements below are prepared once per connection and then reused from sqlite3's
+#statement cache. WAL journaling lets sessions read while another one writes
+
+#the database file, set CHATBOT_DB_PATH to keep it somewhere else
+db_path = os.environ.get('CHATBOT_DB_PATH', 'restaurant_bookings.db')
+
+busy_timeout = 5.0  #seconds a write waits for another writer before failing
+statement_cache_size = 64
+pragmas = [
+    'PRAGMA journal_mode=WAL',  #readers do not block the writer and the writer does not block readers
+    'PRAGMA synchronous=NORMAL',  #safe with WAL, commits do not wait for a full sync
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000'  #8 MB page cache per connection
+]
+
+create_bookings_sql = '''
+    CREATE TABLE IF NOT EXISTS bookings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_name TEXT NOT NULL,
+        booking_date DATE NOT NULL,
+        booking_time TIME NOT NULL,
+        number_of_people INTEGER NOT NULL,
+        dietary TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        active BOOLEAN DEFAULT 1
+    )
+'''
+
+#the schema is changed only by adding a migration to the end of this list, never by editing one
+#a database records how many it has had in PRAGMA user_version, so older files are brought up to date in place
+migrations = [
+    #1: the bookings table, files made before migrations already have it
+    [create_bookings_sql],
+    #2: covering indexes for the lookups of a customer's active bookings (sorted by date and time)
+    #and of their dietary preference, so neither reads the table
+    ['''CREATE INDEX IF NOT EXISTS bookings_customer_active
+        ON bookings (customer_name, active, booking_date, booking_time, number_of_people, dietary)''',
+     '''CREATE INDEX IF NOT EXISTS bookings_customer_dietary
+        ON bookings (customer_name, active, dietary)''',
+     'ANALYZE'],
+    #3: covering index for loading the bookings of one day into the availability model
+    ['''CREATE INDEX IF NOT EXISTS bookings_date_active
+        ON bookings (booking_date, active, booking_time, number_of_people)''',
+     'ANALYZE'],
+    #4: the journal id of bookings written behind by booking_journal, unique so a replay cannot add one twice,
+    #and the day index rebuilt to cover it
+    ['ALTER TABLE bookings ADD COLUMN journal_id TEXT',
+     'CREATE UNIQUE INDEX IF NOT EXISTS bookings_journal_id ON bookings (journal_id)',
+     'DROP INDEX IF EXISTS bookings_date_active',
+     '''CREATE INDEX bookings_date_active
+        ON bookings (booking_date, active, booking_time, number_of_people, journal_id)''']
+]
+
+customer_bookings_sql = '''
+    SELECT id, booking_date, booking_time, number_of_people, dietary
+    FROM bookings
+    WHERE customer_name = ? AND active = 1
+    ORDER BY booking_date, booking_time
+'''
+
+dietary_preference_sql = '''
+    SELECT dietary, COUNT(*) as count
+    FROM bookings
+    WHERE customer_name = ? AND active = 1
+    GROUP BY dietary
+    HAVING count >= 2
+'''
+
+bookings_on_date_sql = '''
+    SELECT id, booking_time, number_of_people, journal_id
+    FROM bookings
+    WHERE booking_date = ? AND active = 1
+    ORDER BY id
+'''
+
+insert_booking_sql = '''
+    INSERT INTO bookings (customer_name, booking_date, booking_time, number_of_people, dietary)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+import_bookings_sql = '''
+    INSERT INTO bookings (customer_name, booking_date, booking_time, number_of_people, dietary, active)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+insert_journaled_sql = '''
+    INSERT OR IGNORE INTO bookings (customer_name, booking_date, booking_time, number_of_people, dietary, journal_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+journaled_id_sql = 'SELECT id FROM bookings WHERE journal_id = ?'
+
+export_bookings_sql = '''
+    SELECT id, customer_name, booking_date, booking_time, number_of_people, dietary, created_at, active
+    FROM bookings
+    {where}
+    ORDER BY id
+'''
+
+booking_details_sql = '''
+    SELECT customer_name, booking_date, booking_time, number_of_people, dietary
+    FROM bookings
+    WHERE id = ? AND active = 1
+'''
+
+cancel_booking_sql = '''
+    UPDATE bookings
+    SET active = 0
+    WHERE id = ? AND active = 1
+'''
+
+#one fixed statement per column that can be changed, so each is prepared once and the column is never formatted in
+update_booking_sql = {
+    column: f'UPDATE bookings SET {column} = ? WHERE id = ?'
+    for column in ('booking_date', 'booking_time', 'number_of_people', 'dietary')
+}
+
+
+class BookingStore:
+    def __init__(self, path=None):
+        self.path = path or db_path
+        self.local = threading.local()
+        self.schema_ready = False
+        self.schema_lock = threading.Lock()
+
+    def connection(self):
+        #the connection of this thread, a process forked from this one opens its own
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=busy_timeout, cached_statements=statement_cache_size)
+            for pragma in pragmas:
+                conn.execute(pragma)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        if not self.schema_ready:
+            self.init_schema(conn)
+        return conn
+
+    def init_schema(self, conn):  #migrates the database the first time any connection is used
+        with self.schema_lock:
+            if not self.schema_ready:
+                migrate(conn)
+                self.schema_ready = True
+
+    @contextmanager
+    def write_transaction(self):
+        #takes the write lock before the first read, so what is read cannot change before the write commits
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def close(self):  #closes the connection of this thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    @timed('customer_bookings', 'booking_store')
+    def customer_bookings(self, customer_name):
+        return self.connection().execute(customer_bookings_sql, (customer_name,)).fetchall()
+
+    @timed('dietary_preference', 'booking_store')
+    def dietary_preference(self, customer_name):
+        result = self.connection().execute(dietary_preference_sql, (customer_name,)).fetchone()
+        return result[0] if result else None
+
+    @timed('bookings_on_date', 'booking_store')
+    def bookings_on_date(self, booking_date):  #(id, time, people, journal id) of the active bookings on a 'YYYY-MM-DD' date
+        return self.connection().execute(bookings_on_date_sql, (booking_date,)).fetchall()
+
+    @timed('insert_booking', 'booking_store')
+    def insert_booking(self, customer_name, booking_date, booking_time, number_of_people, dietary, fits=None):
+        #returns the id of the new booking, None when fits turns it down
+        #fits is called in the transaction with a function reading the bookings of a date, so the check sees the
+        #bookings of every process and no other write can come in between
+        with self.write_transaction() as conn:
+            if fits is not None and not fits(lambda day: conn.execute(bookings_on_date_sql, (day,)).fetchall()):
+                return None
+            cursor = conn.execute(insert_booking_sql,
+                                  (customer_name, booking_date, booking_time, number_of_people, dietary))
+        return cursor.lastrowid
+
+    @timed('insert_bookings', 'booking_store')
+    def insert_bookings(self, rows):
+        #inserts (name, date, time, people, dietary, active) rows with one prepared statement in one transaction
+        conn = self.connection()
+        with conn:
+            conn.executemany(import_bookings_sql, rows)
+
+    @timed('insert_journaled', 'booking_store')
+    def insert_journaled(self, rows):
+        #inserts (name, date, time, people, dietary, journal id) rows in one transaction, skipping those already in
+        #returns the booking id of every journal id
+        conn = self.connection()
+        with conn:
+            conn.executemany(insert_journaled_sql, rows)
+            return {row[-1]: conn.execute(journaled_id_sql, (row[-1],)).fetchone()[0] for row in rows}
+
+    def export_bookings(self, active_only=True):  #a cursor over the bookings, read as they are written out
+        where = 'WHERE active = 1' if active_only else ''
+        return self.connection().execute(export_bookings_sql.format(where=where))
+
+    @timed('update_booking', 'booking_store')
+    def update_booking(self, booking_id, column, value, fits=None):
+        #returns False when fits, called as in insert_booking, turns the change down
+        with self.write_transaction() as conn:
+            if fits is not None and not fits(lambda day: conn.execute(bookings_on_date_sql, (day,)).fetchall()):
+                return False
+            conn.execute(update_booking_sql[column], (value, booking_id))
+        return True
+
+    @timed('booking_details', 'booking_store')
+    def booking_details(self, booking_id):
+        return self.connection().execute(booking_details_sql, (booking_id,)).fetchone()
+
+    @timed('cancel_booking', 'booking_store')
+    def cancel_booking(self, booking_id):  #returns True if an active booking was cancelled
+        conn = self.connection()
+        with conn:
+            cursor = conn.execute(cancel_booking_sql, (booking_id,))
+        return cursor.rowcount > 0
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Run the migrations the database has not had yet, each in its own transaction with the version it sets.
+    The write lock is taken before the version is read, so processes starting together migrate only once.
+    Returns the schema version.
+    """
+    while schema_version(conn) < len(migrations):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(conn)
+            if version < len(migrations):
+                for statement in migrations[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+    return schema_version(conn)
+
+
+booking_store = BookingStore()  #shared by every session of the process, connections are opened per thread
+
+
+if __name__ == '__main__':
+    #migrates a database file in place, the bookings database unless a path is given
+    path = sys.argv[1] if len(sys.argv) > 1 else db_path
+    with sqlite3.connect(path) as conn:
+        before = schema_version(conn)
+        after = migrate(conn)
+    print(f"{path}: schema version {before} -> {after}")
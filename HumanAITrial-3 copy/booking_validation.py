@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+from availability import closing_time, opening_time
+
+#the booking rules, shared by the conversation and the bulk import
+#every check returns the message to show the user, or None when the value is allowed
+
+booking_window_days = 90  #how far ahead a booking can be made
+max_party_size = 20
+dietary_options = ['halal', 'vegan', 'vegetarian', 'kosher', 'pescatarian', 'none']
+
+open_at = datetime.strptime(opening_time, '%H:%M').time()
+close_at = datetime.strptime(closing_time, '%H:%M').time()
+
+
+def check_day_month(day, month):
+    if not (1 <= month <= 12):
+        return "Invalid month. Please provide a month between 1 and 12."
+    if not (1 <= day <= 31):
+        return "Invalid day. Please provide a day between 1 and 31."
+    return None
+
+
+def check_date(booking_date, today=None):
+    today = today or datetime.now().date()
+    if booking_date < today:
+        return f"Sorry, bookings must be for a future date after {today}. Please try again."
+    if booking_date > today + timedelta(days=booking_window_days):
+        return "Sorry, bookings can only be made up to 3 months in advance. Please try again."
+    return None
+
+
+def check_time(booking_time):
+    if booking_time < open_at or booking_time > close_at:
+        return (f"Sorry, our restaurant is only open between {opening_time} and {closing_time}. "
+                "Provide a time within our open hours")
+    return None
+
+
+def check_people(people):
+    if people <= 0:
+        return "Please provide a valid number of people. The number of people must be positive, try again"
+    if people > max_party_size:
+        return (f"Sorry, we can only accommodate parties up to {max_party_size} people. "
+                "For larger groups, please contact us directly.")
+    return None
+
+
+def check_dietary(dietary):
+    if dietary not in dietary_options:
+        return f"Dietary requirement must be one of {', '.join(dietary_options)}."
+    return None
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from main import chat_turn, is_exit, model_specs, recover_bookings, start_conversation
+from model_cache import build_models
+from model_registry import registry
+from nltk_resources import ensure_nltk_resources, MissingNLTKResourceError
+from session import SessionStore
+from turn_analysis import TurnAnalysis
+from worker_pool import WorkerPool
+
+#local HTTP and WebSocket front end, one process serves many conversations at once
+#  POST /chat  {"session_id": ..., "message": ...} -> {"session_id": ..., "replies": [...]}
+#              without a session_id a new conversation is started and its opening lines are returned
+#  GET /ws     WebSocket, every text frame is a message and every reply is a JSON frame like the one above
+#  GET /health number of open sessions and turns in progress
+#the NLP and scoring of a turn run on a thread pool, or with --processes on a pool of forked worker processes,
+#so the event loop is never blocked. Turns of one session run one at a time and new turns are turned away once
+#too many are waiting
+
+host = '127.0.0.1'
+port = 8080
+turn_workers = 4  #threads answering messages
+max_pending_turns = 64  #turns waiting or running before new ones get a 503
+max_body_size = 64 * 1024
+expire_interval = 60  #seconds between checks for idle sessions
+websocket_guid = '258EAFA5-E914-47DA-95CA-C5AB0DC11B85'
+
+status_text = {200: 'OK', 101: 'Switching Protocols', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class LocalTurns:
+    """
+    Answers turns on a thread pool in this process, the sessions are kept here.
+    worker_pool.WorkerPool has the same interface for answering them in worker processes.
+    """
+    def __init__(self, workers=turn_workers):
+        self.sessions = SessionStore()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='turn')
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def start(self, session_id=None):  #returns the session id and a future of the opening lines
+        session = self.sessions.get(session_id)
+        opening = Future()
+        opening.set_result(start_conversation(session))
+        return session.session_id, opening
+
+    def turn(self, session_id, message):  #returns a future of the reply lines
+        return self.executor.submit(chat_turn, self.sessions.get(session_id), message)
+
+    def end(self, session_id):
+        self.sessions.remove(session_id)
+
+    def expire(self):
+        self.sessions.expire()
+
+    def report(self):
+        return []
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class ChatServer:
+    def __init__(self, turns=None, max_pending=max_pending_turns):
+        self.turns = turns if turns is not None else LocalTurns()
+        self.max_pending = max_pending
+        self.pending_turns = 0
+        self.turn_locks = {}  #session id -> lock so the turns of a session run in order
+
+    async def respond(self, session_id, message):
+        """
+        Answer one message, returns (session id, replies).
+        A new or expired session id starts a new conversation and gets the opening lines back.
+        """
+        if session_id is None or session_id not in self.turns:
+            session_id, opening = self.turns.start(session_id)
+            return session_id, await asyncio.wrap_future(opening)
+
+        if is_exit(message):
+            self.turns.end(session_id)
+            self.turn_locks.pop(session_id, None)
+            return session_id, ["Goodbye!"]
+
+        if self.pending_turns >= self.max_pending:
+            raise ServerBusy()
+        self.pending_turns += 1
+        try:
+            lock = self.turn_locks.setdefault(session_id, asyncio.Lock())
+            async with lock:
+                replies = await asyncio.wrap_future(self.turns.turn(session_id, message))
+        finally:
+            self.pending_turns -= 1
+        return session_id, replies
+
+    async def expire_sessions(self):
+        while True:
+            await asyncio.sleep(expire_interval)
+            self.turns.expire()
+            for session_id in list(self.turn_locks):
+                if session_id not in self.turns:
+                    del self.turn_locks[session_id]
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.handle_websocket(reader, writer, path, headers)
+                    break
+                status, payload = await self.handle_http(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            await write_response(writer, e.status, {'error': str(e)}, False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_http(self, method, path, body):
+        route = urlsplit(path).path
+        if route == '/health':
+            return 200, {'status': 'ok', 'sessions': len(self.turns), 'pending_turns': self.pending_turns,
+                         'workers': self.turns.report()}
+        if route != '/chat':
+            return 404, {'error': 'not found'}
+        if method != 'POST':
+            return 405, {'error': 'use POST'}
+        try:
+            request = json.loads(body or b'{}')
+            session_id = request.get('session_id')
+            message = str(request.get('message', ''))
+        except (ValueError, AttributeError):
+            return 400, {'error': 'the body must be a JSON object'}
+        try:
+            session_id, replies = await self.respond(session_id, message)
+        except ServerBusy:
+            return 503, {'error': 'too many messages waiting, try again shortly'}
+        except Exception as e:  #a failed turn is reported to its client, the server carries on
+            print(f"Turn failed: {e!r}", file=sys.stderr)
+            return 500, {'error': 'the message could not be answered'}
+        return 200, {'session_id': session_id, 'replies': replies}
+
+    async def websocket_reply(self, session_id, message):
+        #the frame answering a message, a failed turn is reported in it and the connection stays open
+        try:
+            session_id, replies = await self.respond(session_id, message)
+            return {'session_id': session_id, 'replies': replies}
+        except ServerBusy:
+            return {'session_id': session_id, 'error': 'too many messages waiting, try again shortly'}
+        except Exception as e:
+            print(f"Turn failed: {e!r}", file=sys.stderr)
+            return {'session_id': session_id, 'error': 'the message could not be answered'}
+
+    async def handle_websocket(self, reader, writer, path, headers):
+        key = headers.get('sec-websocket-key')
+        if urlsplit(path).path != '/ws' or not key:
+            await write_response(writer, 404 if key else 400, {'error': 'WebSocket endpoint is /ws'}, False)
+            return
+        accept = base64.b64encode(hashlib.sha1((key + websocket_guid).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+
+        session_id = parse_qs(urlsplit(path).query).get('session_id', [None])[0]
+        reply = {'session_id': session_id, 'replies': []}
+        if session_id not in self.turns:  #a new conversation, an open one carries on where it was
+            reply = await self.websocket_reply(None, '')
+            session_id = reply['session_id']
+        await send_frame(writer, 0x1, json.dumps(reply).encode())
+        if 'error' in reply:  #no conversation to carry on, closed as going away
+            await send_frame(writer, 0x8, struct.pack('!H', 1001))
+            return
+        while True:
+            opcode, payload = await read_message(reader, writer)
+            if opcode == 0x8:  #close
+                await send_frame(writer, 0x8, payload[:2])
+                break
+            if opcode != 0x1:
+                continue
+            reply = await self.websocket_reply(session_id, payload.decode('utf-8', 'replace'))
+            session_id = reply['session_id']
+            await send_frame(writer, 0x1, json.dumps(reply).encode())
+            if session_id not in self.turns:  #the user said goodbye
+                await send_frame(writer, 0x8, struct.pack('!H', 1000))
+                break
+
+
+async def read_request(reader):
+    #returns (method, path, headers, body) or None when the client has closed the connection
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        field, _, value = line.decode('latin-1').partition(':')
+        headers[field.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0) or 0)
+    if length > max_body_size:
+        raise HTTPError(413, 'message too large')
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), path, headers, body
+
+
+async def write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode()
+    head = (f"HTTP/1.1 {status} {status_text.get(status, '')}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode() + body)
+    await writer.drain()
+
+
+async def read_frame(reader):
+    #returns (fin, opcode, payload) of one WebSocket frame, client frames are always masked
+    first, second = await reader.readexactly(2)
+    length = second & 0x7f
+    if length == 126:
+        length = struct.unpack('!H', await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', await reader.readexactly(8))[0]
+    if length > max_body_size:
+        raise ConnectionError('WebSocket frame too large')
+    mask = await reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+    payload = bytearray(await reader.readexactly(length))
+    for i in range(length):
+        payload[i] ^= mask[i % 4]
+    return bool(first & 0x80), first & 0x0f, bytes(payload)
+
+
+async def read_message(reader, writer):
+    #returns (opcode, payload) of the next data or close message, joining fragments and answering pings
+    opcode, parts = None, []
+    while True:
+        fin, frame_opcode, payload = await read_frame(reader)
+        if frame_opcode == 0x9:  #ping
+            await send_frame(writer, 0xa, payload)
+            continue
+        if frame_opcode == 0xa:  #pong
+            continue
+        if frame_opcode == 0x8:
+            return frame_opcode, payload
+        if frame_opcode != 0x0:
+            opcode = frame_opcode
+        parts.append(payload)
+        if sum(len(part) for part in parts) > max_body_size:
+            raise ConnectionError('WebSocket message too large')
+        if fin:
+            return opcode, b''.join(parts)
+
+
+async def send_frame(writer, opcode, payload):
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    writer.write(head + payload)
+    await writer.drain()
+
+
+def warm_up():
+    #runs the NLP pipeline once so lazily loaded NLTK data is not first loaded by several threads at once
+    analysis = TurnAnalysis("Hello, how are you?")
+    analysis.route()
+    analysis.mood
+
+
+async def serve(server_host, server_port, turns, max_pending):
+    chat_server = ChatServer(turns, max_pending)
+    server = await asyncio.start_server(chat_server.handle_connection, server_host, server_port)
+    expiry = asyncio.create_task(chat_server.expire_sessions())
+    print(f"Chatbot server listening on http://{server_host}:{server_port}", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        expiry.cancel()
+        turns.close()
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="HTTP and WebSocket front end for the chatbot")
+    arg_parser.add_argument('--host', default=host)
+    arg_parser.add_argument('--port', type=int, default=port)
+    arg_parser.add_argument('--workers', type=int, default=turn_workers, help="threads answering messages")
+    arg_parser.add_argument('--processes', type=int, default=0,
+                            help="answer messages in this many pre-forked worker processes instead of threads")
+    arg_parser.add_argument('--max-pending', type=int, default=max_pending_turns,
+                            help="turns waiting or running before new ones are turned away")
+    args = arg_parser.parse_args(argv)
+
+    try:
+        ensure_nltk_resources()
+    except MissingNLTKResourceError as e:
+        sys.exit(str(e))
+    recover_bookings()  #before any worker starts journaling
+    registry.reload(build_models(model_specs))
+    registry.load_all()
+    warm_up()
+    if args.processes > 0:
+        #forked now, with the models loaded and before the server starts any thread
+        turns = WorkerPool(args.processes)
+    else:
+        turns = LocalTurns(args.workers)
+    try:
+        asyncio.run(serve(args.host, args.port, turns, args.max_pending))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
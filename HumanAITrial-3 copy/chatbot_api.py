@@ -0,0 +1,111 @@
+import argparse
+import json
+import sys
+import time
+
+import IdentityManagement
+import QuestionAnswering
+import SmallTalk
+import chatbot_discovery
+import restaurantBooking
+from main import model_specs
+from model_cache import build_models
+from model_registry import registry
+from retrieval import score_batch_size
+from turn_analysis import TurnAnalysis
+
+#library API for classifying and answering many utterances at once, e.g. logged traffic or an offline evaluation
+#the whole batch is scored against the fused index and its route index with one matrix product each, which
+#gives both the intent and the best response of every utterance
+#utterances are answered as the first message of a new conversation, so no conversation state is changed
+
+fallback_response = "I'm not sure how to respond to that. Type 'Help' to know more"
+batch_size = 1024  #utterances scored together at most, fewer when the index is so large the score block would not fit
+
+#intent -> function that turns (analysis, highest similarity, best rows, payloads) into a response
+batch_responders = {
+    'question_answering': lambda analysis, max_sim, rows, payloads:
+        QuestionAnswering.answer_from_match(max_sim, rows, payloads),
+    'small_talk': lambda analysis, max_sim, rows, payloads:
+        SmallTalk.talk_from_match(max_sim, rows, payloads) + analysis.mood,
+    'name_management': lambda analysis, max_sim, rows, payloads:
+        IdentityManagement.identity_from_match(analysis.text, max_sim, rows, payloads),
+    'discovery': lambda analysis, max_sim, rows, payloads:
+        chatbot_discovery.discovery_from_match(max_sim),
+    'restaurant_booking': lambda analysis, max_sim, rows, payloads:
+        restaurantBooking.restaurant_from_match(max_sim, rows, payloads)
+}
+
+
+def score_batches(utterances):
+    #yields (analysis, route scores, scores against every row of the fused index) for every utterance
+    fused_index = registry.get('fused')
+    utterances = list(utterances)
+    size = score_batch_size(fused_index.index.matrix.shape[0], batch_size)
+    for start in range(0, len(utterances), size):
+        analyses = [TurnAnalysis(utterance) for utterance in utterances[start:start + size]]
+        texts = [analysis.lemmas for analysis in analyses]
+        route_scores = fused_index.route_score_batch(texts)
+        scores = fused_index.score_batch(texts)
+        for analysis, route_row, row in zip(analyses, route_scores, scores):
+            yield analysis, route_row, row
+
+
+def classify_batch(utterances):
+    """
+    Detect the intent of every utterance using similarity alone.
+    Returns a list of (intent, similarity), the intent is 'unknown' below the route threshold.
+    """
+    fused_index = registry.get('fused')
+    return [fused_index.route(route_scores) for _, route_scores, _ in score_batches(utterances)]
+
+
+def respond_batch(utterances):
+    """
+    Classify every utterance and answer it in the same scoring pass.
+    Returns one dict per utterance with the intent, its similarity, the response and the response similarity.
+    """
+    fused_index = registry.get('fused')
+    results = []
+    for analysis, route_scores, scores in score_batches(utterances):
+        intent, intent_score = fused_index.route(route_scores)
+        result = {
+            'utterance': analysis.text,
+            'intent': intent,
+            'intent_score': intent_score,
+            'response': fallback_response,
+            'response_score': None
+        }
+        responder = batch_responders.get(intent)
+        if responder is not None:
+            max_sim = fused_index.best_in(intent, route_scores)[0]  #the similarity the module thresholds are for
+            _, rows, payloads = fused_index.best_in(intent, scores)
+            result['response'] = responder(analysis, max_sim, rows, payloads)
+            result['response_score'] = float(max_sim)
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Classify and answer one utterance per line as JSON lines")
+    arg_parser.add_argument('input', nargs='?', help="file with one utterance per line, standard input if omitted")
+    args = arg_parser.parse_args(argv)
+
+    build_models(model_specs)
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            utterances = [line.strip() for line in f if line.strip()]
+    else:
+        utterances = [line.strip() for line in sys.stdin if line.strip()]
+
+    start = time.perf_counter()
+    results = respond_batch(utterances)
+    seconds = time.perf_counter() - start
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if seconds > 0:
+        print(f"{len(results)} utterances in {seconds:.2f}s ({len(results) / seconds:.0f}/s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,18 @@
-import numpy as np
-from joblib import dump, load
-from sklearn.feature_extraction.text import TfidfVectorizer
+from joblib import dump
 import pandas as pd
 import random
-from preprocessing import lemmatisation
-from sklearn.metrics import pairwise_distances
+from preprocessing import lemmatisation_full
+from turn_analysis import analyse
 
 data_path = 'Datasets/discovery.csv'
+model_path = 'models/discovery_model.joblib'
+model_config = {'preprocessing': 'lemmatisation_full', 'columns': ('phrase',)}  #used by the build cache
 error_message = [
     "Type either 'current' or 'general' to know more about my functionalities",
     "type current or general please",
     "To know more about the chatot type either 'genral' or 'current'",
     "I am looking for either 'general' or 'current'"
 ]
-previous=None
 discovery=["I can tell you all about the chatbot functionalities such as the small talk, identity management, "
            "question answerting and restaurant booking\n"
            "\tWhen you ask me what I can do you get the option to know more about my functionalities generally or "
@@ -42,90 +41,69 @@ general=[
         )]
 
 THRESHOLD = 0.6
-section= None #the area in which the response should be
-asked= False #has the user been asked general or current
-intent_history = [None, None] #keeps track of current intent and previous one
-df = pd.read_csv(data_path)
+#the discovery context (section, asked, intent_history) is kept in the session
 functionality=["small talk: 'How are you'","identity management: 'my name is...'\n","question Answering: 'what are stocks and bonds'","Restaurant booking:'book a table'"]
-def create_discovery_model(): #create the discovery model
+def create_discovery_model(): #saves the lemmatised discovery phrases for the fused index
     df = pd.read_csv(data_path)
-    df['question'] = df['phrase'].apply(lemmatisation)
+    phrases = df['phrase'].apply(lemmatisation_full)
+    dump((list(phrases), [None] * len(phrases)), model_path)  #the phrases have no payload
 
-    tfidf_vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 4))  #uses 4 n grams for context
-    transform = tfidf_vectorizer.fit_transform(df['question']).toarray()
+def update_intent_history(session, new_intent):    #keeps track of the intents for context tracking
+    session.intent_history.pop(0)  # Remove the oldest intent
+    session.intent_history.append(new_intent)  # Add the new intent
 
-    # Save the vectorizer and transformed data
-    dump((tfidf_vectorizer, transform), 'models/discovery_model.joblib')
-
-def update_intent_history(new_intent):    #keeps track of the intents for context tracking
-    global intent_history
-    intent_history.pop(0)  # Remove the oldest intent
-    intent_history.append(new_intent)  # Add the new intent
-
-# Load the saved small talk model
-def load_discovery_model():
-    discovery_vectorizer, discovery_transform = load('models/discovery_model.joblib')
-    return discovery_vectorizer, discovery_transform
-
-def know(user_query, previous_intent):
-    global asked, section
-    if not asked:
+def know(user_query, previous_intent, session):
+    if not session.asked:
         if previous_intent =="unknown" or previous_intent is None:
-            section ='general'
-            asked=True
+            session.section ='general'
+            session.asked=True
             return None
-        asked = True
+        session.asked = True
         return (f"If you would like to know more about the chatbot in general, type 'general'.\n"
                 f"\t Otherwise, if you would like to know about what you are currently doing ({previous_intent}), type 'current'.")
     else:
         if user_query.lower() == 'general':
-            section = 'general'
-            asked = False
+            session.section = 'general'
+            session.asked = False
         elif user_query.lower() == 'current':
-            section = 'current'
-            asked = False
+            session.section = 'current'
+            session.asked = False
         else:
             return "Please type 'general' or 'current' to continue."
 
 
 
 
+def functionality_response(): #lists everything the chatbot can do
+    response="I have the following functionality:\n"
+    for i in functionality:
+        response= response + " "+i
+    return response
+
+
 # Function to handle small talk response
-def chatbot_discovery(query,previous_intent):
-    global previous, section
-    previous = previous_intent
-    update_intent_history(previous_intent)
-    two_behind_intent = intent_history[0]
+def chatbot_discovery(query,previous_intent, session, analysis=None):
+    update_intent_history(session, previous_intent)
+    two_behind_intent = session.intent_history[0]
 
 
-    if section is None and previous_intent is not None:
-        response = know(query, previous_intent)
+    if session.section is None and previous_intent is not None:
+        response = know(query, previous_intent, session)
         if response:  # Return the response if context setup
             return response
 
 
-    discovery_vectorizer, discovery_transform = load_discovery_model()
-    processed_query = lemmatisation(query)
-    query_transform = discovery_vectorizer.transform([processed_query]).toarray()
-
-    cos_sim = 1 - pairwise_distances(query_transform, discovery_transform, metric='cosine').flatten()
-
-    max_sim = cos_sim.max()
-    matching_indices = np.where(cos_sim == max_sim)[0]
+    max_sim, matching_indices, _ = analyse(query, analysis).match('discovery')
 
     if max_sim >= THRESHOLD:
 
-        if previous_intent is None or section=='general' or previous_intent =="unknown":
-            response="I have the following functionality:\n"
-            for i in functionality:
-                response= response + " "+i
-            section = None
-
-            return response
+        if previous_intent is None or session.section=='general' or previous_intent =="unknown":
+            session.section = None
+            return functionality_response()
 
 
 
-        if section=='current': #get the context specific functionality
+        if session.section=='current': #get the context specific functionality
             intent_map = {
                 "discovery": discovery,
                 "restaurant_booking": restaurant_booking,
@@ -134,7 +112,12 @@ def chatbot_discovery(query,previous_intent):
                 "small_talk": small_talk
             }
             if two_behind_intent in intent_map:
-                section = None
+                session.section = None
                 return random.choice(intent_map[two_behind_intent])
     else:
         return random.choice(error_message)
+
+
+def discovery_from_match(max_sim):
+    #replies as the start of a conversation would, the discovery context is not changed
+    return functionality_response() if max_sim >= THRESHOLD else random.choice(error_message)
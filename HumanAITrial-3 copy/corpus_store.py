@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+#on disk storage for a module corpus that is too large to hold in memory
+#the lemmatised phrases are kept one per line and read back a chunk at a time when the index is built,
+#the payloads (e.g. answers) are kept as one block of text with the offset of each one so a single
+#payload can be read without loading the rest
+
+
+class PayloadStore:
+    """
+    Read only list of the payloads of a streamed corpus, each one is read from disk when it is asked for.
+    """
+    def __init__(self, payloads_path, offsets_path):
+        self.payloads_path = payloads_path
+        self.offsets_path = offsets_path
+        self.offsets = None  #memory mapped, opened on first use
+        self.file = None
+        self.lock = threading.Lock()  #the file position is shared, so one read at a time
+
+    def open(self):
+        if self.offsets is None:
+            with self.lock:
+                if self.offsets is None:
+                    self.file = open(self.payloads_path, 'rb')
+                    self.offsets = np.load(self.offsets_path, mmap_mode='r')
+
+    def __len__(self):
+        self.open()
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        self.open()
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('payload index out of range')
+        start, stop = int(self.offsets[index]), int(self.offsets[index + 1])
+        with self.lock:
+            self.file.seek(start)
+            payload = self.file.read(stop - start)
+        return payload.decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self):  #only the paths are saved, the file and the memory map are opened again after loading
+        return {'payloads_path': self.payloads_path, 'offsets_path': self.offsets_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['payloads_path'], state['offsets_path'])
+
+
+class StreamedCorpus:
+    """
+    A module corpus written by write_streamed_corpus, saved in place of the usual (texts, payloads) pair.
+    """
+    def __init__(self, texts_path, payloads_path, offsets_path, n_rows, digest):
+        self.texts_path = texts_path
+        self.payloads_path = payloads_path
+        self.offsets_path = offsets_path
+        self.n_rows = n_rows
+        self.digest = digest  #hash of the contents, so the saved corpus changes whenever its files do
+
+    def text_chunks(self, chunk_size=10000):  #yields lists of at most chunk_size lemmatised phrases
+        chunk = []
+        with open(self.texts_path, encoding='utf-8') as f:
+            for line in f:
+                chunk.append(line.rstrip('\n'))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def payloads(self):
+        return PayloadStore(self.payloads_path, self.offsets_path)
+
+
+def write_streamed_corpus(chunks, path_prefix):
+    """
+    Write (texts, payloads) chunks to disk one chunk at a time.
+    Texts must not contain line breaks (lemmatised phrases never do). Returns the StreamedCorpus.
+    """
+    texts_path = path_prefix + '.texts'
+    payloads_path = path_prefix + '.payloads'
+    offsets_path = path_prefix + '.offsets.npy'
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    n_rows = 0
+    digest = hashlib.sha256()
+    with open(texts_path + '.tmp', 'w', encoding='utf-8') as texts_file, \
+            open(payloads_path + '.tmp', 'wb') as payloads_file:
+        for texts, payloads in chunks:
+            lengths = []
+            for text, payload in zip(texts, payloads):
+                texts_file.write(text + '\n')
+                encoded = str(payload).encode('utf-8')
+                digest.update(text.encode('utf-8') + b'\n')
+                digest.update(len(encoded).to_bytes(8, 'little') + encoded)
+                payloads_file.write(encoded)
+                lengths.append(len(encoded))
+            offsets.append(position + np.cumsum(lengths, dtype=np.int64))
+            position += sum(lengths)
+            n_rows += len(lengths)
+
+    with open(offsets_path + '.tmp', 'wb') as f:
+        np.save(f, np.concatenate(offsets))
+    #moved into place only once everything is written so a failed build never leaves a mixed corpus
+    for path in (texts_path, payloads_path, offsets_path):
+        os.replace(path + '.tmp', path)
+    return StreamedCorpus(texts_path, payloads_path, offsets_path, n_rows, digest.hexdigest())
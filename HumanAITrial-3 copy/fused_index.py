@@ -0,0 +1,213 @@
+import copy
+
+import numpy as np
+from joblib import load
+
+from corpus_store import StreamedCorpus
+from model_artifacts import read_artifact, sparse_arrays, sparse_from_arrays, write_artifact
+from retrieval import InvertedIndex, SparseIndex
+
+#one index over the phrases of every module
+#each row carries its intent and its module specific payload (answer, response template or identity type),
+#so a single scoring pass picks the intent and the best matching rows inside that intent.
+#the rows are indexed twice: word n-grams pick the best phrase, while the intent and whether a module answers
+#at all are decided on single words. N-grams spread the weight of a phrase over many features, so a short
+#message like "cancel my booking" scores well below the thresholds the intents were tuned with
+
+fused_model_path = 'models/fused_model'  #artifact directory, its arrays are memory mapped and shared by every worker
+
+
+class FusedIndex:
+    def __init__(self, route_threshold, route_vectorizer_params, **vectorizer_params):
+        self.route_threshold = route_threshold  #lowest similarity for any intent to be recognised
+        self.route_vectorizer_params = route_vectorizer_params
+        self.vectorizer_params = vectorizer_params
+        self.index = None  #picks the best rows
+        self.route_index = None  #gives the similarity the route and module thresholds are compared with
+        self.intents = []  #intents in the order of their rows
+        self.starts = None  #first row of every intent, so the intent of a row is a binary search
+        self.slices = {}  #intent -> (first row, last row + 1), the rows of an intent are kept together
+        self.payloads = {}  #intent -> payload of every row of that intent
+        self.thresholds = {}  #intent -> lowest similarity for the module to answer from its best row
+
+    def fit(self, corpora):
+        """
+        Build the index from a list of (intent, text chunks, payloads, threshold), one per module.
+        The text chunks are lists of phrases, with hashing features they are indexed one chunk at a time.
+        """
+        def text_chunks():  #every chunk of every corpus in order, recording where each intent's rows are
+            n_rows = 0
+            for intent, chunks, payloads, threshold in corpora:
+                start = n_rows
+                for chunk in chunks:
+                    chunk = list(chunk)
+                    n_rows += len(chunk)
+                    yield chunk
+                self.intents.append(intent)
+                self.slices[intent] = (start, n_rows)
+                self.payloads[intent] = payloads
+                self.thresholds[intent] = threshold
+
+        index = SparseIndex(**self.vectorizer_params)
+        route_index = SparseIndex(**self.route_vectorizer_params)
+        if index.hashing:
+            def counted_chunks():  #the route index is counted in the same pass over the chunks
+                for chunk in text_chunks():
+                    route_index.add_counts(route_index.count(chunk))
+                    yield chunk
+            route_index.start_counts()
+            self.index = index.fit_chunks(counted_chunks())
+            self.route_index = route_index.finish_counts()
+        else:
+            texts = [text for chunk in text_chunks() for text in chunk]
+            self.index = index.fit(texts)
+            self.route_index = route_index.fit(texts)
+        self.starts = np.array([self.slices[intent][0] for intent in self.intents])
+        return self
+
+    def intent_of(self, row):
+        return self.intents[int(np.searchsorted(self.starts, row, side='right')) - 1]
+
+    def scores(self, text):  #similarity of the text to every row of every module
+        return self.index.scores(text)
+
+    def score_batch(self, texts):
+        return self.index.score_batch(texts)
+
+    def route_score_batch(self, texts):  #score_batch against the route index
+        return self.route_index.score_batch(texts)
+
+    def top_rows(self, text, k, intent=None):
+        #the k best rows for the text from the inverted index, only rows of the intent if one is given
+        row_range = self.slices[intent] if intent is not None else None
+        return self.index.top_k(text, k, row_range)
+
+    def top_route_rows(self, text, k, intent=None):  #top_rows from the route index
+        row_range = self.slices[intent] if intent is not None else None
+        return self.route_index.top_k(text, k, row_range)
+
+    def route_rows(self, rows, scores):
+        #route() for the best rows from top_route_rows, the first row is the best one
+        if rows.size == 0:
+            return "unknown", 0.0
+        max_sim = float(scores[0])
+        if max_sim >= self.route_threshold:
+            return self.intent_of(rows[0]), max_sim
+        return "unknown", max_sim
+
+    def best_in_rows(self, intent, rows, scores):
+        """
+        best_in() for the best rows from top_rows.
+        Returns None when none of the rows belong to the intent.
+        """
+        start, stop = self.slices[intent]
+        in_intent = (rows >= start) & (rows < stop)
+        if not in_intent.any():
+            return None
+        rows, scores = rows[in_intent], scores[in_intent]
+        max_sim = scores[0]
+        return max_sim, rows[scores == max_sim] - start, self.payloads[intent]
+
+    def route(self, scores):
+        #returns the intent of the best matching row and its similarity, 'unknown' below the route threshold
+        #scores are those of route_score_batch
+        if scores.size == 0:
+            return "unknown", 0.0
+        best_row = int(np.argmax(scores))
+        max_sim = float(scores[best_row])
+        intent = self.intent_of(best_row)
+        if max_sim >= self.route_threshold:
+            return intent, max_sim
+        return "unknown", max_sim
+
+    def best_in(self, intent, scores):
+        """
+        The best matching rows of one intent from scores that have already been worked out.
+        Returns (highest similarity, indices of the rows with it inside the intent, payloads of the intent).
+        """
+        start, stop = self.slices[intent]
+        intent_scores = scores[start:stop]
+        if intent_scores.size == 0:
+            return 0.0, np.array([], dtype=int), self.payloads[intent]
+        max_sim = intent_scores.max()
+        return max_sim, np.flatnonzero(intent_scores == max_sim), self.payloads[intent]
+
+
+def index_arrays(index, prefix):
+    #the buffers of a SparseIndex, its inverted index is built here so workers map it instead of building it
+    if index.inverted is None:
+        index.inverted = InvertedIndex(index.matrix)
+    arrays = sparse_arrays(prefix + 'matrix', index.matrix)
+    arrays.update(sparse_arrays(prefix + 'postings', index.inverted.postings))
+    arrays[prefix + 'max_weights'] = index.inverted.max_weights
+    if index.idf is not None:
+        arrays[prefix + 'idf'] = index.idf
+    shapes = {prefix + 'matrix': index.matrix.shape, prefix + 'postings': index.inverted.postings.shape}
+    return arrays, shapes
+
+
+def without_arrays(index):  #a copy of a SparseIndex with the buffers taken out, for the sidecar
+    metadata = copy.copy(index)
+    metadata.matrix = None
+    metadata.idf = None
+    metadata.inverted = copy.copy(index.inverted)
+    metadata.inverted.postings = None
+    metadata.inverted.max_weights = None
+    return metadata
+
+
+def restore_arrays(index, arrays, shapes, prefix):  #puts the mapped buffers back into a SparseIndex
+    index.matrix = sparse_from_arrays(arrays, prefix + 'matrix', shapes[prefix + 'matrix'])
+    index.idf = arrays.get(prefix + 'idf')
+    index.inverted.postings = sparse_from_arrays(arrays, prefix + 'postings', shapes[prefix + 'postings'], 'csc')
+    index.inverted.postings.has_sorted_indices = True  #sorted before saving, the mapped buffers are read only
+    index.inverted.max_weights = arrays[prefix + 'max_weights']
+
+
+def save_fused_index(fused_index, directory):
+    """
+    Save the fused index as an artifact directory (see model_artifacts).
+    The TF-IDF matrices, the inverted index postings and the term weights of both indexes are saved as
+    separate buffers, the vectorizers, slices and payloads go in the sidecar.
+    """
+    arrays, shapes = index_arrays(fused_index.index, '')
+    route_arrays, route_shapes = index_arrays(fused_index.route_index, 'route_')
+    arrays.update(route_arrays)
+    shapes.update(route_shapes)
+
+    #the sidecar holds copies of the objects with the arrays taken out
+    metadata = copy.copy(fused_index)
+    metadata.index = without_arrays(fused_index.index)
+    metadata.route_index = without_arrays(fused_index.route_index)
+    write_artifact(directory, arrays, (metadata, shapes))
+
+
+def load_fused_index(directory, mmap_mode='r'):
+    #loads the fused index with its arrays memory mapped, so they are shared by every process that loads it
+    arrays, (fused_index, shapes) = read_artifact(directory, mmap_mode)
+    restore_arrays(fused_index.index, arrays, shapes, '')
+    restore_arrays(fused_index.route_index, arrays, shapes, 'route_')
+    return fused_index
+
+
+def load_fused_model():
+    return load_fused_index(fused_model_path)
+
+
+
+def create_fused_model(modules, route_threshold, route_vectorizer_params, vectorizer_params, model_path):
+    """
+    Build and save the fused index.
+    modules is a list of (intent, module corpus path, threshold), each corpus holds (texts, payloads)
+    or is a StreamedCorpus whose phrases are read from disk a chunk at a time.
+    """
+    corpora = []
+    for intent, corpus_path, threshold in modules:
+        corpus = load(corpus_path)
+        if isinstance(corpus, StreamedCorpus):
+            corpora.append((intent, corpus.text_chunks(), corpus.payloads(), threshold))
+        else:
+            texts, payloads = corpus
+            corpora.append((intent, [texts], list(payloads), threshold))
+    fused_index = FusedIndex(route_threshold, route_vectorizer_params, **vectorizer_params).fit(corpora)
+    save_fused_index(fused_index, model_path)
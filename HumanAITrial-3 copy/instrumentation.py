@@ -0,0 +1,196 @@
+import bisect
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+#timing of the stages of every turn, off unless CHATBOT_TRACE=1
+#a span times one stage (tokenising, POS tagging, vectorising, scoring, date parsing, sentiment, a SQLite
+#call...) and is tagged with the module doing it and, once the turn is over, the intent of the turn.
+#Spans add to a histogram per stage, module and intent, printed with `kill -USR1 <pid>` or report(), and a
+#turn slower than CHATBOT_SLOW_TURN_MS is logged with the time of each of its stages.
+#turned off, span() hands back one shared empty context and timed() leaves the function as it is
+
+enabled = os.environ.get('CHATBOT_TRACE') == '1'
+slow_turn_ms = float(os.environ.get('CHATBOT_SLOW_TURN_MS', 250))
+slow_turn_log = os.environ.get('CHATBOT_SLOW_TURN_LOG')  #file slow turns are appended to, stderr if not set
+bucket_bounds_ms = [0.01 * 2 ** i for i in range(21)]  #10 microseconds to about 10 seconds
+
+no_span = nullcontext()
+local = threading.local()  #the turn being answered by this thread
+histograms = {}  #(stage, module, intent) -> Histogram
+histograms_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds_ms) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(bucket_bounds_ms, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total_ms += other.total_ms
+        self.max_ms = max(self.max_ms, other.max_ms)
+
+    def percentile(self, q):  #upper bound of the bucket holding the q-th percentile, at most the slowest
+        rank = self.count * q / 100
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(bucket_bounds_ms[index], self.max_ms) if index < len(bucket_bounds_ms) else self.max_ms
+        return self.max_ms
+
+
+def percentile(values, q):  #the q-th percentile of a list of numbers, interpolated between the closest two
+    ordered = sorted(values)
+    index = (len(ordered) - 1) * q / 100
+    lower = int(index)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (index - lower)
+
+
+def add_sample(stage, module, intent, ms):
+    key = (stage, module, intent)
+    with histograms_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.add(ms)
+
+
+class Span:
+    __slots__ = ('stage', 'module', 'start')
+
+    def __init__(self, stage, module):
+        self.stage = stage
+        self.module = module
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        ms = (time.perf_counter() - self.start) * 1000
+        turn = getattr(local, 'turn', None)
+        if turn is None:  #outside a turn, e.g. while building models
+            add_sample(self.stage, self.module, None, ms)
+        else:
+            turn.spans.append((self.stage, self.module, ms))
+
+
+class TurnSpan:
+    #collects the spans of one turn and files them under its intent when the turn ends
+    def __init__(self):
+        self.intent = None
+        self.spans = []
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        local.turn = self
+        return self
+
+    def __exit__(self, *exc_info):
+        local.turn = None
+        total_ms = (time.perf_counter() - self.start) * 1000
+        for stage, module, ms in self.spans:
+            add_sample(stage, module, self.intent, ms)
+        add_sample('turn', 'main', self.intent, total_ms)
+        if total_ms >= slow_turn_ms:
+            log_slow_turn(self, total_ms)
+
+
+def span(stage, module):
+    #use as `with span('tokenise', 'preprocessing'):`
+    return Span(stage, module) if enabled else no_span
+
+
+def turn():  #wraps the answering of one message
+    return TurnSpan() if enabled else no_span
+
+
+def set_intent(intent):  #tags the spans of the current turn with its intent
+    if enabled:
+        current = getattr(local, 'turn', None)
+        if current is not None:
+            current.intent = intent
+
+
+def timed(stage, module):
+    #decorator timing every call of a function as a span, the function is left untouched when disabled
+    def decorate(function):
+        if not enabled:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(stage, module):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def log_slow_turn(turn_span, total_ms):
+    stages = ', '.join(f"{module}.{stage} {ms:.1f}" for stage, module, ms in turn_span.spans)
+    line = f"slow turn {total_ms:.1f} ms intent={turn_span.intent}: {stages}\n"
+    if slow_turn_log:
+        with open(slow_turn_log, 'a', encoding='utf-8') as f:
+            f.write(line)
+    else:
+        sys.stderr.write(line)
+
+
+def snapshot(by_intent=True):  #the histograms as plain data, with by_intent=False the intents are added up
+    with histograms_lock:
+        if by_intent:
+            merged = histograms
+        else:
+            merged = {}
+            for (stage, module, _), histogram in histograms.items():
+                merged.setdefault((stage, module, None), Histogram()).merge(histogram)
+        items = sorted(merged.items(), key=lambda item: (item[0][1], item[0][0], str(item[0][2])))
+        return [{'stage': stage, 'module': module, 'intent': intent, 'count': h.count,
+                 'mean_ms': h.total_ms / h.count, 'p50_ms': h.percentile(50), 'p95_ms': h.percentile(95),
+                 'p99_ms': h.percentile(99), 'max_ms': h.max_ms}
+                for (stage, module, intent), h in items]
+
+
+def report():
+    lines = [f"{'module.stage':<34}{'intent':<22}{'count':>7}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}"
+             f"{'p99 ms':>10}{'max ms':>10}"]
+    for row in snapshot():
+        lines.append(f"{row['module'] + '.' + row['stage']:<34}{str(row['intent']):<22}{row['count']:>7}"
+                     f"{row['mean_ms']:>10.2f}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+                     f"{row['max_ms']:>10.2f}")
+    return '\n'.join(lines)
+
+
+def reset():
+    with histograms_lock:
+        histograms.clear()
+
+
+def dump_report():
+    sys.stderr.write(f"stage timings of process {os.getpid()}\n{report()}\n")
+
+
+def on_dump_signal(signum, frame):
+    #the handler runs in the main thread between two of its bytecodes, maybe inside add_sample with
+    #histograms_lock held, so the report is written from a thread of its own
+    threading.Thread(target=dump_report, name='stage-report', daemon=True).start()
+
+
+if enabled and hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGUSR1, on_dump_signal)
@@ -0,0 +1,236 @@
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+#load generator for sizing a deployment, run from this directory
+#  python load_test.py --users 200 --rate 20 --think 0.5
+#replays recorded conversations as many simulated users answered in this process at the same time. Users
+#arrive at random with the given mean rate, each follows one transcript with a random pause between messages,
+#so their bookings, pending bookings, selections, modifications and cancellations interleave on one database.
+#a turn answered with a fallback reply, or not answered, counts as an error of its transcript like an exception
+#every run is appended as one JSON line to the output file so runs can be compared
+
+transcripts_path = 'Datasets/load_transcripts.jsonl'
+results_path = 'load_results.jsonl'
+first_names = ['Ava', 'Ben', 'Cara', 'Dev', 'Ella', 'Finn', 'Gita', 'Hugo', 'Isla', 'Jack', 'Kemi', 'Liam']
+
+
+def user_name(index):
+    #a distinct name made of letters only, so every user has bookings of their own
+    suffix = ''
+    index, rest = divmod(index, len(first_names))
+    while index:
+        index, letter = divmod(index - 1, 26)
+        suffix = chr(ord('a') + letter) + suffix
+    return first_names[rest] + suffix
+
+
+def fallback_replies():  #what the chatbot says to a message it did not understand
+    import SmallTalk
+    from preprocessing import error_message
+    return set(error_message) | set(SmallTalk.error_message)
+
+
+def is_fallback(lines, fallbacks):
+    return not lines or any(fallback in line for line in lines for fallback in fallbacks)
+
+
+def load_transcripts(path):  #[(name, messages)], messages may use {name}, {date} and {date2}
+    transcripts = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                transcript = json.loads(line)
+                transcripts.append((transcript['name'], transcript['messages']))
+    return transcripts
+
+
+class Recorder:
+    #the results of every simulated user, shared by their threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)  #transcript -> turn seconds
+        self.errors = collections.Counter()  #error type -> turns
+        self.transcript_errors = collections.Counter()  #transcript -> turns that failed or got a fallback reply
+        self.database_locked = 0
+        self.active_users = 0
+        self.peak_users = 0
+        self.finished_users = 0
+
+    def user_started(self):
+        with self.lock:
+            self.active_users += 1
+            self.peak_users = max(self.peak_users, self.active_users)
+
+    def user_finished(self):
+        with self.lock:
+            self.active_users -= 1
+            self.finished_users += 1
+
+    def turn(self, transcript, seconds, error=None, fallback=False):
+        with self.lock:
+            self.latencies[transcript].append(seconds)
+            if error is not None or fallback:
+                self.transcript_errors[transcript] += 1
+            if fallback:
+                self.errors['fallback reply'] += 1
+            if error is not None:
+                self.errors[type(error).__name__] += 1
+                if 'locked' in str(error):
+                    self.database_locked += 1
+
+
+def simulate_user(index, transcript, think_time, recorder, seed):
+    from main import chat_turn, start_conversation
+    from session import Session
+
+    name, messages = transcript
+    fallbacks = fallback_replies()
+    rng = random.Random(seed)
+    values = {'name': user_name(index),
+              'date': (date.today() + timedelta(days=rng.randint(1, 30))).strftime('%d/%m/%Y'),
+              'date2': (date.today() + timedelta(days=rng.randint(31, 60))).strftime('%d/%m/%Y')}
+    recorder.user_started()
+    try:
+        session = Session()
+        start_conversation(session)
+        chat_turn(session, "Loadbot")
+        for message in messages:
+            start = time.perf_counter()
+            try:
+                lines = chat_turn(session, message.format(**values))
+                recorder.turn(name, time.perf_counter() - start, fallback=is_fallback(lines, fallbacks))
+            except Exception as e:  #counted, the user carries on like a real one would
+                recorder.turn(name, time.perf_counter() - start, e)
+            if think_time > 0:
+                time.sleep(rng.expovariate(1 / think_time))
+    finally:
+        recorder.user_finished()
+
+
+def run(users, rate, think_time, transcripts, seed):
+    #starts the users at random arrival times and waits for all of them, returns (recorder, wall seconds)
+    rng = random.Random(seed)
+    recorder = Recorder()
+    threads = []
+    start = time.perf_counter()
+    for index in range(users):
+        if rate > 0:
+            time.sleep(rng.expovariate(rate))
+        thread = threading.Thread(target=simulate_user, name=f'user-{index}',
+                                  args=(index, transcripts[index % len(transcripts)], think_time, recorder,
+                                        rng.random()))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def latency_summary(seconds):
+    from instrumentation import percentile
+    milliseconds = [s * 1000 for s in seconds]
+    return {'turns': len(milliseconds), 'p50_ms': percentile(milliseconds, 50),
+            'p95_ms': percentile(milliseconds, 95), 'p99_ms': percentile(milliseconds, 99),
+            'max_ms': max(milliseconds)}
+
+
+def results_of(args, recorder, wall_seconds):
+    import instrumentation
+    every_turn = [s for seconds in recorder.latencies.values() for s in seconds]
+    #time spent in each SQLite call, waits for the write lock included
+    sqlite = {row['stage']: {key: row[key] for key in ('count', 'mean_ms', 'p95_ms', 'max_ms')}
+              for row in instrumentation.snapshot(by_intent=False) if row['module'] == 'booking_store'}
+    return {
+        'label': args.label,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'users': args.users,
+        'rate': args.rate,
+        'think_time': args.think,
+        'transcripts': args.transcripts,
+        'write_behind': os.environ.get('CHATBOT_WRITE_BEHIND') == '1',
+        'wall_seconds': wall_seconds,
+        'throughput_turns_per_second': len(every_turn) / wall_seconds,
+        'peak_concurrent_users': recorder.peak_users,
+        'latency': latency_summary(every_turn),
+        'per_transcript': {name: dict(latency_summary(seconds), errors=recorder.transcript_errors[name])
+                           for name, seconds in recorder.latencies.items()},
+        'errors': dict(recorder.errors),
+        'database_locked': recorder.database_locked,
+        'sqlite': sqlite
+    }
+
+
+def report(results):
+    latency = results['latency']
+    lines = [f"{results['users']} users, {latency['turns']} turns in {results['wall_seconds']:.1f}s: "
+             f"{results['throughput_turns_per_second']:.1f} turns/s, peak {results['peak_concurrent_users']} "
+             f"users at once",
+             f"turn latency p50 {latency['p50_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, "
+             f"p99 {latency['p99_ms']:.1f} ms, max {latency['max_ms']:.1f} ms",
+             f"errors: {results['errors'] or 'none'}, database locked: {results['database_locked']}"]
+    for name, stats in results['per_transcript'].items():
+        if stats['errors']:
+            lines.append(f"  transcript {name:<20}{stats['errors']:>7} of {stats['turns']} turns failed")
+    for stage, stats in results['sqlite'].items():
+        lines.append(f"  sqlite {stage:<20}{stats['count']:>7} calls, p95 {stats['p95_ms']:.2f} ms, "
+                     f"max {stats['max_ms']:.2f} ms")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Replay conversation transcripts as concurrent users")
+    arg_parser.add_argument('--users', type=int, default=50, help="simulated users in the run")
+    arg_parser.add_argument('--rate', type=float, default=10.0,
+                            help="mean users arriving per second, 0 starts them all at once")
+    arg_parser.add_argument('--think', type=float, default=0.2, help="mean seconds a user pauses between messages")
+    arg_parser.add_argument('--transcripts', default=transcripts_path)
+    arg_parser.add_argument('--output', default=results_path, help="file the result of the run is appended to")
+    arg_parser.add_argument('--label', default='', help="name of the run in the output file")
+    arg_parser.add_argument('--db', help="bookings database to use, a throwaway one by default")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args(argv)
+
+    #set before the chatbot modules are imported, they read it once
+    work_dir = tempfile.mkdtemp(prefix='chatbot-load-')
+    os.environ['CHATBOT_DB_PATH'] = args.db or os.path.join(work_dir, 'bookings.db')
+    os.environ['CHATBOT_JOURNAL_PATH'] = os.path.join(work_dir, 'bookings.journal')
+    os.environ['CHATBOT_TRACE'] = '1'  #the SQLite timings come from the stage spans
+    os.environ.setdefault('CHATBOT_SLOW_TURN_MS', 'inf')
+    try:
+        from booking_journal import booking_journal
+        from main import model_specs, recover_bookings
+        from model_cache import build_models
+        from model_registry import registry
+        from nltk_resources import ensure_nltk_resources, MissingNLTKResourceError
+        try:
+            ensure_nltk_resources()
+        except MissingNLTKResourceError as e:
+            sys.exit(str(e))
+        recover_bookings()
+        build_models(model_specs)
+        registry.load_all()
+
+        recorder, wall_seconds = run(args.users, args.rate, args.think, load_transcripts(args.transcripts),
+                                     args.seed)
+        results = results_of(args, recorder, wall_seconds)
+        if booking_journal is not None:  #written out before the throwaway database goes
+            booking_journal.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(report(results))
+    with open(args.output, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(results) + '\n')
+    print(f"Result appended to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,67 @@
+import argparse
+import sys
 from datetime import datetime
 
-import pandas as pd
-from joblib import dump, load
-from sklearn.feature_extraction.text import TfidfVectorizer
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import IdentityManagement
+import QuestionAnswering
+import SmallTalk
+import chatbot_discovery as discovery_module
+import restaurantBooking
 from IdentityManagement import identity_management,create_identity_model
 from QuestionAnswering import QuestionAnwering,create_question_model
 from SmallTalk import talk_response,create_smalltalk_model
 from chatbot_discovery import chatbot_discovery,create_discovery_model
-from restaurantBooking import restaurant_response, BookingManager,create_restaurant_model
-from preprocessing import contains_date_time_or_number, sentiment_response
-
-
-booking_manager = BookingManager()
-chatbot_name = "Chatbot" #name of the chatbot by default
-
-#the code used to create my identity model
-
-def create_intent_model():
-    # Data loading and preprocessing steps
-    files = [
-        ('Datasets/smallTalk.csv', 'small_talk', 'phrase'),
-        ('Datasets/COMP3074-CW1-Dataset.csv', 'question_answering', 'Question'),
-        ('Datasets/IdentityManagement.csv', 'name_management', 'phrase'),
-        ('Datasets/discovery.csv', 'discovery', 'phrase'),
-        ('Datasets/RestaurantBooking.csv', 'restaurant_booking', 'phase')
-    ]
-
-    intent_data = []
-    for file, intent_label, phrase_column in files:
-        df = pd.read_csv(file)
-        df['intent'] = intent_label
-        df = df.rename(columns={phrase_column: 'phrase'})
-        df = df.dropna(subset=['phrase'])
-        intent_data.append(df[['phrase', 'intent']])
-
-    intent_df = pd.concat(intent_data, ignore_index=True)
-
-    # Train a vectorizer
-    vectorizer = TfidfVectorizer()
-    intent_vectors = vectorizer.fit_transform(intent_df['phrase']).toarray()
-    intent_labels = intent_df['intent'].values
-
-    # Save the model and vectorizer
-    dump((vectorizer, intent_vectors, intent_labels), 'models/intent_model.joblib')
-
-
-def load_intent_model():
-    vectorizer, intent_vectors, intent_labels = load('models/intent_model.joblib')
-    return vectorizer, intent_vectors, intent_labels
+from restaurantBooking import restaurant_response,create_restaurant_model
+from session import Session
+from turn_analysis import TurnAnalysis, analyse
+from fused_index import create_fused_model as create_fused_index, fused_model_path
+from model_cache import build_models
+from model_registry import registry
+from nltk_resources import ensure_nltk_resources, MissingNLTKResourceError
+from booking_journal import booking_journal, replay_journals
+from instrumentation import set_intent, span, turn
+
+
+INTENT_THRESHOLD = 0.6  #lowest similarity for an intent to be recognised
+
+#hashing features when the QA dataset is streamed, so the index is built without holding a vocabulary or every phrase
+fused_vectorizer_params = {'analyzer': 'word', 'ngram_range': (1, 4), 'hashing': QuestionAnswering.streaming}
+#single words decide the intent and whether a module answers, the thresholds below are tuned for them
+#numbers are left out, a date or party size says nothing about the intent but dilutes the similarity
+fused_route_params = {'analyzer': 'word', 'ngram_range': (1, 1), 'token_pattern': r"(?u)\b[^\W\d]\w+\b",
+                      'hashing': QuestionAnswering.streaming}
+#(intent, module corpus, threshold for the module to answer) for every module in the fused index
+fused_modules = [
+    ('small_talk', SmallTalk.model_path, SmallTalk.THRESHOLD),
+    ('question_answering', QuestionAnswering.model_path, QuestionAnswering.THRESHOLD),
+    ('name_management', IdentityManagement.model_path, IdentityManagement.THRESHOLD),
+    ('discovery', discovery_module.model_path, discovery_module.THRESHOLD),
+    ('restaurant_booking', restaurantBooking.model_path, restaurantBooking.THRESHOLD)
+]
+fused_model_config = {'vectorizer': fused_vectorizer_params, 'route_vectorizer': fused_route_params,
+                      'modules': fused_modules, 'route_threshold': INTENT_THRESHOLD}
+
+#the fused index routes every message and picks the response in one scoring pass
+
+def create_fused_model():
+    create_fused_index(fused_modules, INTENT_THRESHOLD, fused_route_params, fused_vectorizer_params,
+                       fused_model_path)
+
+
+#(name, create function, model path, input paths, config) for the build cache
+#the module corpora are built first and the fused index is rebuilt whenever one of them changes
+model_specs = [
+    ('identity', create_identity_model, IdentityManagement.model_path, [IdentityManagement.data_path],
+     IdentityManagement.model_config),
+    ('question', create_question_model, QuestionAnswering.model_path, [QuestionAnswering.data_path],
+     QuestionAnswering.model_config),
+    ('smalltalk', create_smalltalk_model, SmallTalk.model_path, [SmallTalk.data_path], SmallTalk.model_config),
+    ('discovery', create_discovery_model, discovery_module.model_path, [discovery_module.data_path],
+     discovery_module.model_config),
+    ('restaurant', create_restaurant_model, restaurantBooking.model_path, [restaurantBooking.data_path],
+     restaurantBooking.model_config),
+    ('fused', create_fused_model, fused_model_path, [corpus for _, corpus, _ in fused_modules], fused_model_config)
+]
 
 def get_time_greeting():
     current_time = datetime.now().hour
@@ -60,10 +72,14 @@ def get_time_greeting():
     else:
         return "Good evening"
 
-def detect_intent(user_input, vectorizer, intent_vectors, intent_labels, previous_intent, booking_manager):
+def detect_intent(user_input, previous_intent, booking_manager, analysis=None):
 
     #Detect the intent of user input, considering context and booking state.
 
+    # Check if the booking is waiting for the user's name
+    if booking_manager.data.get("awaiting_name"):
+        return "restaurant_booking"
+
     # Check if  in the middle of a modification flow
     if booking_manager.data.get("modifying_booking"):
         return "restaurant_booking"
@@ -72,10 +88,6 @@ def detect_intent(user_input, vectorizer, intent_vectors, intent_labels, previou
     if booking_manager.data.get("awaiting_booking_selection"):
         return "restaurant_booking"
 
-    # Check for booking-specific commands first
-    cancel_phrases = ["cancel", "delete", "remove"]
-    change_phrases = ["change", "modify", "update"]
-
     # Handle yes/no responses in context
     if user_input.lower() in ["yes", "no"]:
         if not booking_manager.is_active() and not booking_manager.data["confirming_cancellation"]:
@@ -104,157 +116,232 @@ def detect_intent(user_input, vectorizer, intent_vectors, intent_labels, previou
         return 'restaurant_booking'
 
     # Handle active booking context
-    if booking_manager.is_active() and contains_date_time_or_number(user_input):
+    if booking_manager.is_active() and analyse(user_input, analysis).has_booking_details:
         return 'restaurant_booking'
 
     # Regular intent detection
-    user_vector = vectorizer.transform([user_input]).toarray()
-    similarities = cosine_similarity(user_vector, intent_vectors).flatten()
-    max_sim = similarities.max()
-    max_index = np.argmax(similarities)
+    intent, _ = analyse(user_input, analysis).route()
+    return intent
+
 
-    THRESHOLD = 0.6
-    return intent_labels[max_index] if max_sim >= THRESHOLD else "unknown"
+def switch_response(intent, user_query, session, analysis):
+    #the response from the task the user has switched to, None for the tasks handle_response answers
+    if intent == 'question_answering':
+        return QuestionAnwering(user_query, analysis)
+    elif intent == 'small_talk':
+        return talk_response(user_query, analysis) + analysis.mood
+    elif intent == 'discovery':
+        return chatbot_discovery(user_query, None, session, analysis)
+    return None
 
 
-def handle_booking_state(booking_manager, current_intent, user_query, previous_intent):
+def handle_booking_state(session, current_intent, user_query, previous_intent, analysis=None):
   #handles the booking state
+  #returns (turn answered, intent, response), a turn that is answered does not change the previous intent
+    analysis = analyse(user_query, analysis)
+    booking_manager = session.booking_manager
 
     if not booking_manager.is_active() or current_intent == 'restaurant_booking':
         return False, current_intent, None
 
     if booking_manager.data["date"] is not None:
         missing_info = booking_manager.get_missing_info()
-        print(f"{chatbot_name}: You haven't finished your booking yet - I still need {missing_info}. "
-              "Would you like to switch tasks? (yes/no)")
-
-        confirmation = input("You: ").lower()
-        if confirmation == "yes":
-            booking_manager.store_current_as_pending()
-            # Process new query with appropriate intent
-            if previous_intent == 'question_answering':
-                return False, 'question_answering', QuestionAnwering(user_query)
-            elif previous_intent == 'small_talk':
-                return False, 'small_talk', talk_response(user_query) + sentiment_response(user_query)
-            elif previous_intent == 'discovery':
-                return False, 'discovery', chatbot_discovery(user_query, None
-                                                             )
-            else:
-                return False, current_intent, None
-        elif confirmation == "no":
-            return False, 'restaurant_booking', None
-        else:
-            print(f"{chatbot_name}: Please answer 'yes' or 'no'")
-            return True, current_intent, None
+        #the answer comes as the next message and is handled by answer_switch
+        session.switch_request = (user_query, current_intent, previous_intent)
+        return True, current_intent, (f"You haven't finished your booking yet - I still need {missing_info}. "
+                                      "Would you like to switch tasks? (yes/no)")
 
     booking_manager.reset()  # Resets the booking state
-    if current_intent == 'question_answering':
-        return False, 'question_answering', QuestionAnwering(user_query)
-    elif current_intent == 'small_talk':
-        return False, 'small_talk', talk_response(user_query) + sentiment_response(user_query)
-    elif current_intent == 'discovery':
-        return False, 'discovery', chatbot_discovery(user_query, None)
-    else:
+    return False, current_intent, switch_response(current_intent, user_query, session, analysis)
+
+
+def answer_switch(session, confirmation):
+    #handles the yes/no answer to the switch tasks question for the message that asked it
+    user_query, current_intent, previous_intent = session.switch_request
+    booking_manager = session.booking_manager
+    confirmation = confirmation.lower()
+    if confirmation == "yes":
+        session.switch_request = None
+        booking_manager.store_current_as_pending()
+        # Process new query with appropriate intent
+        response = switch_response(previous_intent, user_query, session, analyse(user_query))
+        if response is not None:
+            return False, previous_intent, response
         return False, current_intent, None
+    elif confirmation == "no":
+        session.switch_request = None
+        return False, 'restaurant_booking', None
+    else:
+        return True, current_intent, "Please answer 'yes' or 'no'"
 
 
-def handle_response(intent, user_query, booking_manager, previous_intent):
+def handle_response(intent, user_query, session, previous_intent, analysis=None):
     #Generate appropriate response based on intent.
+    analysis = analyse(user_query, analysis)
+    booking_manager = session.booking_manager
     if intent == 'restaurant_booking':
-        if not booking_manager.is_active() and booking_manager.has_pending_booking():
+        if (not booking_manager.is_active() and booking_manager.has_pending_booking()
+                and not booking_manager.data.get("awaiting_name")):
             # Get the details of the pending booking
             pending_details = booking_manager.get_pending_booking_details()
             return (f"You have an unfinished booking:\n{pending_details}\n"
                     "Would you like to continue it? (yes/no)")
-        response = restaurant_response(user_query, booking_manager,chatbot_name)
+        response = restaurant_response(user_query, session, analysis)
         if response:
-            return response + sentiment_response(user_query)
+            return response + analysis.mood
         return ""
 
     responses = {
-        'small_talk': lambda: talk_response(user_query) + sentiment_response(user_query),
-        'question_answering': lambda: QuestionAnwering(user_query),
-        'name_management': lambda: identity_management(user_query),
-        'discovery': lambda: chatbot_discovery(user_query, previous_intent)
+        'small_talk': lambda: talk_response(user_query, analysis) + analysis.mood,
+        'question_answering': lambda: QuestionAnwering(user_query, analysis),
+        'name_management': lambda: identity_management(user_query, session, analysis),
+        'discovery': lambda: chatbot_discovery(user_query, previous_intent, session, analysis)
     }
 
     return responses.get(intent, lambda: "I'm not sure how to respond to that. Type 'Help' to know more")()
 
-def main():
-    global chatbot_name
-    # Initialize models and booking manager
-    create_intent_model()
-    create_identity_model()
-    create_question_model()
-    create_smalltalk_model()
-    create_discovery_model()
-    create_restaurant_model()
-
-    vectorizer, intent_vectors, intent_labels = load_intent_model()
-    booking_manager = BookingManager()
-    previous_intent = None
+def parse_args(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Restaurant booking chatbot")
+    arg_parser.add_argument('--rebuild', action='store_true',
+                            help="refit every model even if its datasets have not changed")
+    arg_parser.add_argument('--model-stats', action='store_true',
+                            help="print the load time and memory use of each model")
+    return arg_parser.parse_args(argv)
+
+
+def start_conversation(session):
+    #the opening lines of a conversation, the next message is the chatbot's new name
+    session.naming_chatbot = True
     greeting = get_time_greeting()
-    print(f"Chatbot: {greeting}! I'm a restaurant booking chatbot.Feel free to ask me anything."
-          f"more about me or type 'exit'"
-          "when you're ready to leave.\n")
-    print(f"Chatbot: Chatbot sounds so boring 😭, Change my name to something more interesting!")
-    chatbot_name = input("Type in my new name: ").strip()
-    print(f"{chatbot_name}: If you are stuck what to do type 'help' to know more!!")
+    return [f"{greeting}! I'm a restaurant booking chatbot.Feel free to ask me anything."
+            f"more about me or type 'exit'"
+            "when you're ready to leave.\n",
+            f"Chatbot sounds so boring 😭, Change my name to something more interesting!"]
 
-    while True:
-        user_query = input("You: ").strip().capitalize()
 
-        # Handle exit command
-        if user_query.lower() in ["exit", "quit", "bye"]:
-            print(f"{chatbot_name}: Goodbye!")
-            break
+def name_chatbot(session, new_name):
+    session.naming_chatbot = False
+    session.chatbot_name = new_name.strip()
+    return [f"If you are stuck what to do type 'help' to know more!!"]
+
+
+def chat_turn(session, user_query):
+    """
+    Answer one message of a conversation.
+    Returns the lines the chatbot says back. Nothing is printed and no handler waits for input, a question
+    asked in the middle of a task is kept in the session and answered by the next message.
+    """
+    with turn():  #times the stages of the turn when CHATBOT_TRACE is set
+        return answer_turn(session, user_query)
+
+
+def answer_turn(session, user_query):
+    if session.naming_chatbot:
+        return name_chatbot(session, user_query)
+
+    booking_manager = session.booking_manager
+    user_query = user_query.strip().capitalize()
+
+    if session.switch_request is not None:
+        #the message answers the switch tasks question, the message that asked it is the one answered
+        question_query = session.switch_request[0]
+        answered, current_intent, direct_response = answer_switch(session, user_query)
+        user_query = question_query
+        analysis = TurnAnalysis(user_query)
+    else:
+        analysis = TurnAnalysis(user_query)  #the NLP work for this message is done once and shared
 
         # Detect intent
-        current_intent = detect_intent(
-            user_query,
-            vectorizer,
-            intent_vectors,
-            intent_labels,
-            previous_intent,
-            booking_manager
-        )
+        with span('detect_intent', 'main'):
+            current_intent = detect_intent(
+                user_query,
+                session.previous_intent,
+                booking_manager,
+                analysis
+            )
+        set_intent(current_intent)
         if not booking_manager.is_active() and booking_manager.has_pending_booking():
             if user_query.lower() in ["yes", "yeah", "yep"]:
-                next_step = booking_manager.resume_pending_booking()
-                print(f"{chatbot_name}: ", next_step)
-                continue
+                return [booking_manager.resume_pending_booking()]
             elif user_query.lower() in ["no", "nope"]:
                 booking_manager.reset()
-                print(f"{chatbot_name}: Starting a new booking. On what date (dd/mm/yyyy) would you like to book the table?")
-                continue
+                return ["Starting a new booking. On what date (dd/mm/yyyy) would you like to book the table?"]
 
         # Handle booking state
+        answered, direct_response = False, None
         if booking_manager.is_active() and current_intent != 'restaurant_booking':
-            should_continue, new_intent, direct_response = handle_booking_state(
-                booking_manager,
+            answered, current_intent, direct_response = handle_booking_state(
+                session,
                 current_intent,
                 user_query,
-                previous_intent
+                session.previous_intent,
+                analysis
             )
-            if should_continue:
-                continue
-            if direct_response:
-                print(f"{chatbot_name}:", direct_response)
-                previous_intent = new_intent
-                continue
-            current_intent = new_intent
-
-        # Generate and print response
+
+    set_intent(current_intent)
+    if answered:
+        return booking_manager.take_messages() + [direct_response]
+    if direct_response:
+        session.previous_intent = current_intent
+        return booking_manager.take_messages() + [direct_response]
+
+    # Generate the response
+    with span('respond', 'main'):
         response = handle_response(
             current_intent,
             user_query,
-            booking_manager,
-            previous_intent
+            session,
+            session.previous_intent,
+            analysis
         )
-        if response:
-            print(f"{chatbot_name}:", response)
+    session.previous_intent = current_intent
+    lines = booking_manager.take_messages()  #messages from the middle of the turn come first
+    if response:
+        lines.append(response)
+    return lines
+
+
+def is_exit(user_query):
+    return user_query.strip().lower() in ["exit", "quit", "bye"]
+
+
+def recover_bookings():  #writes the bookings journaled by a run that stopped before writing them
+    if booking_journal is not None:
+        replayed = replay_journals()
+        if replayed:
+            print(f"Recovered {replayed} journaled bookings", file=sys.stderr)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        ensure_nltk_resources()  #fail with a clear message before the conversation starts
+    except MissingNLTKResourceError as e:
+        sys.exit(str(e))
+    recover_bookings()
+    # Initialize models and booking manager, only the models whose inputs changed are rebuilt
+    rebuilt = build_models(model_specs, rebuild=args.rebuild)
+    registry.reload(rebuilt)  #a rebuilt model replaces any copy that was already loaded
+    registry.load_all()
+    if args.model_stats:
+        print(registry.report())
+
+    session = Session()  #the state of this conversation
+    for line in start_conversation(session):
+        print(f"Chatbot: {line}")
+    for line in name_chatbot(session, input("Type in my new name: ")):
+        print(f"{session.chatbot_name}: {line}")
+
+    while True:
+        user_query = input("You: ")
+
+        # Handle exit command
+        if is_exit(user_query):
+            print(f"{session.chatbot_name}: Goodbye!")
+            break
 
-        previous_intent = current_intent
+        for line in chat_turn(session, user_query):
+            print(f"{session.chatbot_name}:", line)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+import os
+import shutil
+
+import numpy as np
+from joblib import dump, load
+from scipy import sparse
+
+#model artifact format that lets worker processes share one copy of the numeric arrays
+#an artifact is a directory with every array saved as its own uncompressed .npy buffer and a small joblib
+#sidecar holding everything else (vocabulary, payloads, settings). The arrays are opened with mmap, so every
+#process mapping the same files reads the same pages of the page cache instead of keeping a private copy
+
+sidecar_name = 'metadata.joblib'
+
+
+def sparse_arrays(name, matrix):  #the three buffers of a CSR or CSC matrix
+    return {name + '_data': matrix.data, name + '_indices': matrix.indices, name + '_indptr': matrix.indptr}
+
+
+def sparse_from_arrays(arrays, name, shape, matrix_format='csr'):
+    #builds the matrix around the mapped buffers without copying them
+    matrix_class = sparse.csr_matrix if matrix_format == 'csr' else sparse.csc_matrix
+    parts = (arrays[name + '_data'], arrays[name + '_indices'], arrays[name + '_indptr'])
+    return matrix_class(parts, shape=shape, copy=False)
+
+
+def write_artifact(directory, arrays, metadata):
+    """
+    Save arrays (name -> numpy array) and metadata as an artifact directory.
+    The artifact is written next to the old one and swapped in at the end, so a failed build never leaves
+    a mixed artifact and processes still mapping the old files keep working.
+    """
+    tmp_dir = directory + '.tmp'
+    old_dir = directory + '.old'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(array))
+    dump(metadata, os.path.join(tmp_dir, sidecar_name))
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(directory):
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def read_artifact(directory, mmap_mode='r'):
+    #returns (name -> array, metadata), with mmap_mode=None the arrays are read into private memory instead
+    arrays = {}
+    for file_name in os.listdir(directory):
+        if file_name.endswith('.npy'):
+            arrays[file_name[:-len('.npy')]] = np.load(os.path.join(directory, file_name), mmap_mode=mmap_mode)
+    return arrays, load(os.path.join(directory, sidecar_name))
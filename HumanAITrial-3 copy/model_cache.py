@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+
+#build cache for the models in models/
+#each model is keyed on a hash of its dataset files, the preprocessing and retrieval code and its vectorizer config
+#so a model is only refitted when one of its inputs has changed
+
+manifest_path = 'models/manifest.json'
+code_paths = ['preprocessing.py', 'retrieval.py', 'fused_index.py', 'corpus_store.py', 'model_artifacts.py']  #code that changes what ends up in a saved model
+
+
+def file_digest(digest, path):  #adds the contents of a file to the hash
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+
+
+def input_hash(data_paths, config):
+    digest = hashlib.sha256()
+    for path in data_paths:
+        digest.update(path.encode())
+        file_digest(digest, path)
+    for path in code_paths:  #a change to the preprocessing or the index format changes every model
+        file_digest(digest, path)
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def load_manifest():
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):  #no manifest yet or it is unreadable so everything is rebuilt
+        return {}
+
+
+def save_manifest(manifest):
+    #written to a temporary file first so a crash never leaves a half written manifest
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def build_models(model_specs, rebuild=False):
+    """
+    Build the models whose inputs have changed.
+    model_specs is a list of (name, create function, model path, dataset paths, config).
+    Returns the names of the models that were rebuilt.
+    """
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    manifest = load_manifest()
+    rebuilt = []
+    for name, create_model, model_path, data_paths, config in model_specs:
+        current_hash = input_hash(data_paths, config)
+        if not rebuild and manifest.get(name) == current_hash and os.path.exists(model_path):
+            continue  #the saved model is up to date
+
+        create_model()
+        manifest[name] = current_hash
+        save_manifest(manifest)  #saved after every model so finished work is kept if a later one fails
+        rebuilt.append(name)
+    return rebuilt
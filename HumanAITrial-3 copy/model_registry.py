@@ -0,0 +1,109 @@
+import mmap
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+#keeps every model resident in memory so the handlers do not load them from disk on every message
+#each module registers the function that loads its model and asks the registry for it when it needs it
+
+
+def is_mapped(array):  #is the array backed by a memory mapped file rather than private memory
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+def model_memory(obj, seen=None, mapped=False):
+    """
+    Estimate the memory used by a loaded model in bytes.
+    Counts numpy buffers, sparse matrices, pandas objects and the attributes of objects such as vectorizers.
+    With mapped=True only memory mapped arrays are counted, those pages are shared by every process.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    own_size = 0 if mapped else sys.getsizeof(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes if is_mapped(obj) == mapped else 0
+    if sparse.issparse(obj):
+        return sum(model_memory(getattr(obj, part), seen, mapped) for part in ('data', 'indices', 'indptr')
+                   if hasattr(obj, part))
+    if isinstance(obj, (pd.Series, pd.DataFrame, pd.Index)):
+        return 0 if mapped else int(np.sum(obj.memory_usage(deep=True)))
+    if isinstance(obj, dict):
+        return own_size + sum(model_memory(k, seen, mapped) + model_memory(v, seen, mapped) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return own_size + sum(model_memory(item, seen, mapped) for item in obj)
+    if hasattr(obj, '__dict__'):
+        return own_size + model_memory(vars(obj), seen, mapped)
+    return own_size
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.loaders = {}  #name -> function that loads the model from disk
+        self.models = {}  #name -> the loaded model
+        self.stats = {}  #name -> load time and memory of the loaded model
+        self.lock = threading.Lock()
+
+    def register(self, name, loader):
+        self.loaders[name] = loader
+
+    def get(self, name):  #returns the resident model, it is only loaded the first time it is asked for
+        model = self.models.get(name)
+        if model is None:
+            with self.lock:
+                if name not in self.models:
+                    self._load(name)
+                model = self.models[name]
+        return model
+
+    def _load(self, name):
+        start = time.perf_counter()
+        model = self.loaders[name]()
+        load_seconds = time.perf_counter() - start
+        self.models[name] = model
+        self.stats[name] = {
+            'load_seconds': load_seconds,
+            'memory_bytes': model_memory(model),
+            'mapped_bytes': model_memory(model, mapped=True)
+        }
+
+    def load_all(self):  #loads every registered model up front so the first message is not slow
+        for name in self.loaders:
+            self.get(name)
+
+    def reload(self, names=None):
+        """
+        Load models from disk again, e.g. after they have been rebuilt.
+        With no names every registered model is reloaded.
+        """
+        if names is None:
+            names = list(self.loaders)
+        with self.lock:
+            for name in names:
+                if name in self.loaders:  #names without a loader, e.g. a module corpus, are not kept resident
+                    self._load(name)
+
+    def report(self):
+        lines = []
+        for name in sorted(self.stats):
+            stats = self.stats[name]
+            line = (f"{name}: loaded in {stats['load_seconds'] * 1000:.1f} ms, "
+                    f"{stats['memory_bytes'] / 1024:.1f} KiB")
+            if stats['mapped_bytes']:
+                line += f" + {stats['mapped_bytes'] / 1024:.1f} KiB shared (memory mapped)"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+registry = ModelRegistry()
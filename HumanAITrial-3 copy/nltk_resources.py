@@ -0,0 +1,92 @@
+import os
+import sys
+import threading
+
+#checks the NLTK data the chatbot needs once, the first time any NLP function is used, instead of
+#downloading at import time. Resources are looked up in a vendored nltk_data directory first so a
+#deployment can start without network access.
+
+nltk_resources = {  #download id -> path looked up with nltk.data.find
+    'wordnet': 'corpora/wordnet',
+    'stopwords': 'corpora/stopwords',
+    'averaged_perceptron_tagger_eng': 'taggers/averaged_perceptron_tagger_eng',
+    'punkt_tab': 'tokenizers/punkt_tab',  #used by word_tokenize
+    'universal_tagset': 'taggers/universal_tagset',
+    'vader_lexicon': 'sentiment/vader_lexicon.zip'
+}
+
+#the vendored data directory, nltk_data next to this file unless CHATBOT_NLTK_DATA says otherwise
+vendored_data_dir = os.environ.get(
+    'CHATBOT_NLTK_DATA', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nltk_data'))
+
+#set CHATBOT_NLTK_DOWNLOAD=1 to allow missing resources to be downloaded into the vendored directory
+allow_download = os.environ.get('CHATBOT_NLTK_DOWNLOAD', '') == '1'
+
+resources_checked = False
+check_lock = threading.Lock()
+
+
+class MissingNLTKResourceError(LookupError):
+    pass
+
+
+def use_vendored_data():
+    import nltk
+
+    if vendored_data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, vendored_data_dir)  #the vendored copy is preferred over any system copy
+
+
+def missing_resources():
+    import nltk
+
+    missing = []
+    for resource_id, resource_path in nltk_resources.items():
+        try:
+            nltk.data.find(resource_path)
+        except LookupError:
+            missing.append(resource_id)
+    return missing
+
+
+def download_resources(resource_ids, download_dir=vendored_data_dir):
+    import nltk
+
+    os.makedirs(download_dir, exist_ok=True)
+    for resource_id in resource_ids:
+        nltk.download(resource_id, download_dir=download_dir, quiet=True)
+
+
+def ensure_nltk_resources():
+    """
+    Make sure every NLTK resource is available, this only does the work the first time it is called.
+    Raises MissingNLTKResourceError naming the missing resources and how to install them.
+    """
+    global resources_checked
+    if resources_checked:
+        return
+
+    with check_lock:
+        if resources_checked:
+            return
+        use_vendored_data()
+        missing = missing_resources()
+        if missing and allow_download:
+            download_resources(missing)
+            missing = missing_resources()
+        if missing:
+            raise MissingNLTKResourceError(
+                f"Missing NLTK data: {', '.join(missing)}. Install it with "
+                f"'python -m nltk.downloader -d \"{vendored_data_dir}\" {' '.join(missing)}' "
+                f"or set CHATBOT_NLTK_DOWNLOAD=1 to download it on first use.")
+        resources_checked = True
+
+
+if __name__ == '__main__':
+    #downloads every resource into the vendored directory so it can be shipped with a deployment
+    use_vendored_data()
+    download_resources(nltk_resources)
+    still_missing = missing_resources()
+    if still_missing:
+        sys.exit(f"Could not download: {', '.join(still_missing)}")
+    print(f"NLTK data installed in {vendored_data_dir}")
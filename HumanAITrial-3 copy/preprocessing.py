@@ -1,23 +1,48 @@
-from datetime import datetime
-
-import nltk
-import pandas as pd
-from nltk import WordNetLemmatizer, edit_distance
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-import re
-from dateutil import parser
-from joblib import dump
-from nltk.sentiment import SentimentIntensityAnalyzer
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-nltk.download('wordnet',quiet=True)
-nltk.download('stopwords',quiet=True)
-nltk.download('averaged_perceptron_tagger_eng',quiet=True)
-nltk.download('punkt',quiet=True)
-nltk.download('universal_tagset',quiet=True)
-nltk.download('vader_lexicon',quiet=True)
-lemmatiser = WordNetLemmatizer()
+from functools import lru_cache
+
+from instrumentation import span
+from nltk_resources import ensure_nltk_resources
+from slot_parser import find_slots
+
+#nltk is only imported and its data only checked the first time one of these functions is used,
+#so importing this module is cheap
+
+postmap = {  #universal POS tags to the wordnet tags used by the lemmatiser
+    'ADJ': 'a',
+    'NOUN': 'n',
+    'VERB': 'v',
+    'ADV': 'r'
+}
+lemma_cache_size = 4096  #number of distinct texts whose lemmas are remembered
+
+
+@lru_cache(maxsize=None)
+def get_stop_words(): #built once, a set lookup instead of scanning a list per token
+    ensure_nltk_resources()
+    from nltk.corpus import stopwords
+    return frozenset(stopwords.words('english'))
+
+@lru_cache(maxsize=None)
+def get_lemmatiser():
+    ensure_nltk_resources()
+    from nltk import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+@lru_cache(maxsize=None)
+def get_sentiment_analyzer():
+    ensure_nltk_resources()
+    from nltk.sentiment import SentimentIntensityAnalyzer
+    return SentimentIntensityAnalyzer()
+
+def word_tokenize(text):
+    ensure_nltk_resources()
+    from nltk.tokenize import word_tokenize as nltk_word_tokenize
+    return nltk_word_tokenize(text)
+
+def pos_tag(tokens):
+    ensure_nltk_resources()
+    from nltk import pos_tag as nltk_pos_tag
+    return nltk_pos_tag(tokens, tagset='universal')
 
 
 #generic fall back error messages
@@ -42,14 +67,13 @@ name_error =[
 ]
 
 #sentiment analysis
-sia = SentimentIntensityAnalyzer()
-
 def analyze_sentiment(user_query):
     """
     Analyze the sentiment of a user query.
     Returns: 'positive', 'negative', or 'neutral'.
     """
-    sentiment_score = sia.polarity_scores(user_query)['compound']
+    with span('sentiment', 'preprocessing'):
+        sentiment_score = get_sentiment_analyzer().polarity_scores(user_query)['compound']
     if sentiment_score > 0.05:
         return "positive"
     elif sentiment_score < -0.05:
@@ -58,111 +82,93 @@ def analyze_sentiment(user_query):
         return "neutral"
 
 
+mood_messages = {
+    'positive': "😊",  #emoji added to positive
+    'negative': "😟"  #added to negative
+}
+
+
 def sentiment_response(user_query):
-    sentiment = analyze_sentiment(user_query)
-    mood_message = ""
-    if sentiment == "positive": #emoji added to positive
-        mood_message = "😊"
-    elif sentiment == "negative": #added to negative
-        mood_message = "😟"
-    return mood_message
+    return mood_messages.get(analyze_sentiment(user_query), "")
 
 
 def contains_date_time_or_number(user_input):
     #checks if the imputs contains a date time or number of guests pattern
-    date_pattern = r"\b(?:\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}[/-]\d{1,2}[/-]\d{1,2})\b"
-    time_pattern = r"\b(?:\d{1,2}[:.]\d{2}(?:\s*[apAP][mM])?|\d{1,2}\s*[apAP][mM])\b"
-    number_pattern = r"\b(\d+)\s*(?:people|persons|guests|seats|tables?)\b"
-    simple_number_pattern = r"\b\d+\b"
-
-    if re.search(simple_number_pattern, user_input):
-        return True
-
-    # Check for date
-    date_match = re.search(date_pattern, user_input)
-    if date_match:
-        try:
-            # Confirm it's a valid date
-            parser.parse(date_match.group(), dayfirst=True)
-            return True
-        except ValueError:
-            pass
-
-    # Check for time
-    time_match = re.search(time_pattern, user_input)
-    if time_match:
-        try:
-            # Confirm it's a valid time
-            parser.parse(time_match.group(), fuzzy=True)
-            return True
-        except ValueError:
-            pass
-
-    # Check for number
-    if re.search(number_pattern, user_input):
-        return True
-
-    # If none of the patterns matched
-    return False
-
+    return any(value is not None for value in find_slots(user_input).values())
 
 
-def tokenisation(text):
-    token_text=word_tokenize(text)
 
-    text_wt_sw=[word.lower() for word in token_text if not word in stopwords.words('english')]
-    if len(text_wt_sw)>=1: #this was done because some of the questions where all stopwords. this meant that they could not be matched
+def remove_stopwords(token_text, min_words):
+    #removes the stopwords, the tokens are kept as they are if fewer than min_words would be left
+    stop_words=get_stop_words()
+    text_wt_sw=[word.lower() for word in token_text if word not in stop_words]
+    if len(text_wt_sw)>=min_words:
         return text_wt_sw
     else:
         return token_text
 
-def lemmatisation(text): #this function is used to lemmatise the text using the tokenize function
-    tokens=[]
-    postmap={
-        'ADJ': 'a',
-        'NOUN':'n',
-        'VERB':'v',
-        'ADV': 'r'
-    }
-
-    post=nltk.pos_tag(tokenisation(text), tagset='universal') #adds the tags to the tokenised words using the tokenisation function
-    for token in post:
-        word=token[0]
-        tag=token[1]
-        if tag in postmap.keys():
-            tokens.append(lemmatiser.lemmatize(word, postmap[tag])) #appends the lemmatised word to the final list of words
-        else:
-           tokens.append(lemmatiser.lemmatize(word))
-    return " ".join(tokens) #this returns the final list
+def tokenisation(text):
+    #at least one word has to be left because some of the questions where all stopwords. this meant that they could not be matched
+    return remove_stopwords(word_tokenize(text), 1)
 
 def tokenisation_q(text): #specific to question answerint
-    token_text=word_tokenize(text)
+    # only words when there is less than not less than or equals to
+    return remove_stopwords(word_tokenize(text), 2)
 
-    text_wt_sw=[word.lower() for word in token_text if not word in stopwords.words('english')]
-    if len(text_wt_sw)>1: # only words when there is less than not less than or equals to
-        return text_wt_sw
-    else:
-        return token_text
-
-def lemmatisation_q(text): #this function is used to lemmatise the text using the tokenize function
+def lemmatise_tagged(post): #lemmatises the words using their POS tags
     tokens=[]
-    postmap={
-        'ADJ': 'a',
-        'NOUN':'n',
-        'VERB':'v',
-        'ADV': 'r'
-    }
-
-    post=nltk.pos_tag(tokenisation_q(text), tagset='universal') #adds the tags to the tokenised words using the tokenisation function
-    for token in post:
-        word=token[0]
-        tag=token[1]
-        if tag in postmap.keys():
+    lemmatiser=get_lemmatiser()
+    for word, tag in post:
+        if tag in postmap:
             tokens.append(lemmatiser.lemmatize(word, postmap[tag])) #appends the lemmatised word to the final list of words
         else:
            tokens.append(lemmatiser.lemmatize(word))
     return " ".join(tokens) #this returns the final list
 
+def lemmatise_tokens(token_text): #lemmatises a list of tokens using their POS tags
+    return lemmatise_tagged(pos_tag(token_text))
 
+def normalise_text(text):
+    #lower case with the whitespace collapsed so the same message typed differently shares a cache entry
+    #and a capitalised first word is still recognised as a stopword
+    return " ".join(text.lower().split())
 
+@lru_cache(maxsize=lemma_cache_size)
+def analyse_text(text, pipeline='full'):
+    """
+    Tokenise, POS tag and lemmatise a normalised text, returns (tokens, tags, lemmas).
+    The 'full' pipeline keeps the stopwords, 'general' and 'question' remove them like tokenisation and tokenisation_q.
+    """
+    with span('tokenise', 'preprocessing'):
+        token_text = word_tokenize(text)
+        if pipeline == 'general':
+            token_text = remove_stopwords(token_text, 1)
+        elif pipeline == 'question':
+            token_text = remove_stopwords(token_text, 2)
+    with span('pos_tag', 'preprocessing'):
+        tags = tuple(pos_tag(token_text)) #adds the tags to the tokenised words
+    with span('lemmatise', 'preprocessing'):
+        lemmas = lemmatise_tagged(tags)
+    return tuple(token_text), tags, lemmas
+
+def lemmatisation(text): #this function is used to lemmatise the text using the tokenize function
+    return analyse_text(normalise_text(text), 'general')[2]
+
+def lemmatisation_q(text): #lemmatisation specific to question answering
+    return analyse_text(normalise_text(text), 'question')[2]
+
+def lemmatisation_full(text):
+    #lemmatises every word including the stopwords, used for the fused index where words like 'my' and 'your'
+    #are what tells the intents apart
+    return analyse_text(normalise_text(text))[2]
+
+def lemma_cache_stats():
+    """
+    Hit and miss counts of the lemma cache.
+    Every hit is a message that did not need tokenising, POS tagging and lemmatising again.
+    """
+    info = analyse_text.cache_info()
+    return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'maxsize': info.maxsize}
 
+def clear_lemma_cache():
+    analyse_text.cache_clear()
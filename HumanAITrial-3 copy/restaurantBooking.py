@@ -1,19 +1,31 @@
 import sqlite3
+import sys
 import pandas as pd
-from sklearn.feature_extraction.text import TfidfVectorizer
-import numpy as np
-from datetime import datetime, timedelta
-from joblib import dump, load
-from sklearn.metrics import pairwise_distances
-from preprocessing import lemmatisation
-import re
-from dateutil import parser
+from joblib import dump
+from preprocessing import lemmatisation_full
+from turn_analysis import analyse
 import random
+import time
 from IdentityManagement import identity_management, extract_name
-
-chatbot_name="Chatbot" #generic name of the chatbot
+from booking_store import booking_store
+from instrumentation import span
+from booking_journal import booking_journal
+from availability import Availability, closing_time, opening_time, parse_booking, table_availability
+from booking_validation import max_party_size
+from slot_parser import extract_slots
+
+data_path = 'Datasets/RestaurantBooking.csv'
+model_path = 'models/restaurant_model.joblib'
+model_config = {'preprocessing': 'lemmatisation_full', 'columns': ('phrase', 'Response')}  #used by the build cache
+THRESHOLD = 0.7
+bookings_cache_ttl = 5 * 60  #seconds cached bookings are trusted, bookings changed by other sessions show up after this
 class BookingManager: #handles the booking details and states
-    def __init__(self):
+    def __init__(self, store=None, availability=None, journal=None):
+        self.store = store or booking_store  #the database access, shared by every session unless one is given
+        #confirmed bookings are written behind through the journal when CHATBOT_WRITE_BEHIND is set
+        self.journal = journal or (None if store else booking_journal)
+        #free tables per slot, shared like the store
+        self.availability = availability or (Availability(store) if store else table_availability)
         self.data = {
             "name": None,
             "date": None,
@@ -29,35 +41,26 @@ class BookingManager: #handles the booking details and states
             "awaiting_modification_field": False,
             "awaiting_new_value": False,
             "modification_field": None,
-            "last_operation": None
+            "last_operation": None,
+            "awaiting_name": None  #the request waiting for the user's name
         }
         self.pending_booking = None #if a booking has been interrputed
         self.restaurant_hours = {
-            'open': '11:00',
-            'close': '23:00'
+            'open': opening_time,
+            'close': closing_time
         }
-        self.max_party_size = 20
-        self.init_database()
-
-    def init_database(self):  #creates the database
-        conn = sqlite3.connect('restaurant_bookings.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS bookings (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        customer_name TEXT NOT NULL,
-                        booking_date DATE NOT NULL,
-                        booking_time TIME NOT NULL,
-                        number_of_people INTEGER NOT NULL,
-                        dietary TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        active BOOLEAN DEFAULT 1
-                    )
-                ''')
-
-        conn.commit()
-        conn.close()
+        self.max_party_size = max_party_size
+        self.messages = []  #messages for the user from the middle of a turn
+        #customer name -> (time read, active bookings) and (time read, dietary preference), cleared on every write
+        self.bookings_cache = {}
+        self.dietary_cache = {}
+
+    def say(self, message):  #shown to the user before the response of the turn
+        self.messages.append(message)
+
+    def take_messages(self):  #returns the messages of this turn and clears them
+        messages, self.messages = self.messages, []
+        return messages
 
     def is_active(self):   #is the booking active?
         return self.data["booking_active"]
@@ -91,38 +94,65 @@ class BookingManager: #handles the booking details and states
     def has_confirmed_booking(self):  #has all the booking details been eneterd
         return self.data["confirmed"]
 
+    def cached(self, cache, customer_name):  #the cached value for the customer, None if missing or too old
+        entry = cache.get(customer_name)
+        if entry is None or time.monotonic() - entry[0] > bookings_cache_ttl:
+            return None
+        return entry[1]
+
+    def invalidate_bookings(self):  #called after every write so the next read goes to the database
+        self.bookings_cache.clear()
+        self.dietary_cache.clear()
+
     def get_customer_bookings(self, customer_name):  # get all the booking of the users name
-        conn = sqlite3.connect('restaurant_bookings.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT id, booking_date, booking_time, number_of_people, dietary
-            FROM bookings 
-            WHERE customer_name = ? AND active = 1
-            ORDER BY booking_date, booking_time
-        ''', (customer_name,))
-
-        bookings = cursor.fetchall()
-        conn.close()
+        #read once and reused by the following turns of the cancel or modify flow
+        bookings = self.cached(self.bookings_cache, customer_name)
+        if bookings is None:
+            if self.journal:  #bookings the customer just confirmed are read back
+                self.journal.wait_written(customer_name)
+            bookings = self.store.customer_bookings(customer_name)
+            self.bookings_cache[customer_name] = (time.monotonic(), bookings)
         return bookings
 
     def get_dietary_preference(self, customer_name):  #gets the dietary prefernces of the user
        #if the customer has two or more booking with the same dietary then is a preference
-        conn = sqlite3.connect('restaurant_bookings.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT dietary, COUNT(*) as count
-            FROM bookings
-            WHERE customer_name = ? AND active = 1
-            GROUP BY dietary
-            HAVING count >= 2
-        ''', (customer_name,))
-
-        result = cursor.fetchone()
-        conn.close()
-
-        return result[0] if result else None
+        entry = self.dietary_cache.get(customer_name)
+        if entry is None or time.monotonic() - entry[0] > bookings_cache_ttl:
+            if self.journal:
+                self.journal.wait_written(customer_name)
+            entry = (time.monotonic(), self.store.dietary_preference(customer_name))
+            self.dietary_cache[customer_name] = entry
+        return entry[1]
+
+    def shown(self, detail):  #a booking detail as the user reads it, times without seconds
+        value = self.data[detail]
+        return value.strftime('%H:%M') if detail == 'time' and value else str(value)
+
+    def unavailable_message(self, booking_date, booking_time, people, booking_id=None):
+        #None when a table is free, otherwise the nearest free times to offer instead
+        if self.availability.is_available(booking_date, booking_time, people, booking_id):
+            return None
+        free_times = self.availability.nearest_free(booking_date, booking_time, people, booking_id)
+        if not free_times:
+            return f"Sorry, we are fully booked for {people} people on {booking_date}. Please choose another date."
+        return (f"Sorry, we have no table for {people} people at {booking_time.strftime('%H:%M')} on {booking_date}. "
+                f"The nearest free times are {', '.join(t.strftime('%H:%M') for t in free_times)}. "
+                "Which time would you like?")
+
+    def booking_slot(self, booking_id):  #(date, time, people) of an active booking, None if there is none
+        details = self.get_booking_details(booking_id)
+        if details is None:
+            return None
+        return parse_booking(details[1], details[2]) + (details[3],)
+
+    def moved_booking(self, booking_id, field, value):
+        #(date, time, people) of the booking with one of them changed, None if it is no longer active
+        current = self.booking_slot(booking_id)
+        if current is None:
+            return None
+        booking = dict(zip(('date', 'time', 'people'), current))
+        booking[field] = value
+        return booking['date'], booking['time'], booking['people']
 
     def validate_booking_selection(self, query):
         try:
@@ -156,23 +186,30 @@ class BookingManager: #handles the booking details and states
     def save_booking_to_db(self):  #when booking complete save to db
         if self.data["name"] and self.data["date"] and self.data["time"] and self.data["people"] and self.data[
             "dietary"]:
-            conn = sqlite3.connect('restaurant_bookings.db')
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                INSERT INTO bookings (customer_name, booking_date, booking_time, number_of_people,dietary)
-                VALUES (?, ?, ?, ?,?)
-            ''', (
-                self.data["name"],
-                self.data["date"].strftime('%Y-%m-%d'),
-                self.data["time"].strftime('%H:%M'),
-                self.data["people"],
-                self.data["dietary"]
-            ))
-
-            booking_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
+            #the tables are held while the booking is written, so two sessions cannot take the last one
+            reservation = self.journal.new_id() if self.journal else object()
+            if not self.availability.book(reservation, self.data["date"], self.data["time"], self.data["people"]):
+                return False
+            row = (self.data["name"], self.data["date"].strftime('%Y-%m-%d'), self.data["time"].strftime('%H:%M'),
+                   self.data["people"], self.data["dietary"])
+            try:
+                if self.journal:
+                    #acknowledged once journaled, the tables are known by the journal id until the writer saves the row
+                    self.journal.append(*row, journal_id=reservation)
+                    booking_id = None
+                else:
+                    #checked again in the database, another process may have taken the tables
+                    booking_id = self.store.insert_booking(*row, fits=self.availability.fits(
+                        self.data["date"], self.data["time"], self.data["people"]))
+                    if booking_id is None:
+                        self.availability.cancel(reservation, self.data["date"])
+                        self.availability.forget(self.data["date"])  #read again for the times still free
+                        return False
+                    self.availability.rename(reservation, booking_id, self.data["date"])
+            except (sqlite3.Error, OSError):
+                self.availability.cancel(reservation, self.data["date"])
+                raise
+            self.invalidate_bookings()
             self.data["booking_id"] = booking_id
             self.data["booking_active"] = False
             return True
@@ -180,8 +217,6 @@ class BookingManager: #handles the booking details and states
 
     def update_booking(self, booking_id, field, value):
        #when modified the booking updates in the SQL
-        conn = sqlite3.connect('restaurant_bookings.db')
-        cursor = conn.cursor()
 
         # Map the field names to database column names
         field_mapping = {
@@ -194,28 +229,34 @@ class BookingManager: #handles the booking details and states
         # Get the correct database column name
         db_field = field_mapping.get(field)
         if not db_field:
-            conn.close()
             return False
 
         # Format the value based on field type
+        original_value = value
         if field == "date":
             value = value.strftime('%Y-%m-%d')
         elif field == "time":
             value = value.strftime('%H:%M')
 
+        moved = fits = None
+        if field != 'dietary':  #date, time and people move the booking's tables
+            current = self.booking_slot(booking_id)
+            moved = self.moved_booking(booking_id, field, original_value)
+            if current is None or not self.availability.move(booking_id, current[0], *moved):
+                return False
+            fits = self.availability.fits(*moved, booking_id=booking_id)  #checked again in the database
+
         try:
-            cursor.execute(f'''
-                UPDATE bookings 
-                SET {db_field} = ?
-                WHERE id = ?
-            ''', (value, booking_id))
-
-            conn.commit()
-            conn.close()
-            return True
-        except Exception as e:
-            print(f"Database error: {e}")
-            conn.close()
+            if self.store.update_booking(booking_id, db_field, value, fits=fits):
+                self.invalidate_bookings()
+                return True
+            self.availability.move(booking_id, moved[0], *current)
+            self.availability.forget(moved[0])  #another process took the tables, the day is read again
+            return False
+        except sqlite3.Error as e:
+            if moved is not None:  #give the booking its old tables back
+                self.availability.move(booking_id, moved[0], *current)
+            print(f"Database error: {e}", file=sys.stderr)  #the user is told by the reply, this is for the operator
             return False
 
     def confirm_booking(self):
@@ -273,7 +314,8 @@ class BookingManager: #handles the booking details and states
             "awaiting_modification_field": False,
             "awaiting_new_value": False,
             "modification_field": None,
-            "last_operation": None
+            "last_operation": None,
+            "awaiting_name": None  #the request waiting for the user's name
         }
 
     def set_name(self, customer_name):
@@ -281,47 +323,27 @@ class BookingManager: #handles the booking details and states
         self.data["booking_active"] = True
 
     def get_booking_details(self, booking_id):
-        conn = sqlite3.connect('restaurant_bookings.db')
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT customer_name, booking_date, booking_time, number_of_people, dietary
-            FROM bookings 
-            WHERE id = ? AND active = 1
-        ''', (booking_id,))
-
-        booking = cursor.fetchone()
-        conn.close()
-        return booking
+        #taken from the cached bookings when the booking is one of them
+        for customer_name in self.bookings_cache:
+            for booking in self.cached(self.bookings_cache, customer_name) or ():
+                if booking[0] == booking_id:
+                    return (customer_name,) + tuple(booking[1:])
+        return self.store.booking_details(booking_id)
 
     def delete_booking(self, booking_id):
-        #deletes the booking in the SQL database
+        #cancels the booking in the SQL database
         try:
-            conn = sqlite3.connect('restaurant_bookings.db')
-            cursor = conn.cursor()
-
-            # Use parameterized query to prevent SQL injection
-            cursor.execute('''
-                UPDATE bookings 
-                SET active = 0 
-                WHERE id = ? AND active = 1
-            ''', (booking_id,))
-
-            # Check if a row was actually updated
-            rows_affected = cursor.rowcount
-
-            conn.commit()
-            conn.close()
-
-            if rows_affected > 0:
+            current = self.booking_slot(booking_id)
+            cancelled = self.store.cancel_booking(booking_id)
+            self.invalidate_bookings()
+            if cancelled:
+                self.availability.cancel(booking_id, current[0])
                 self.reset()  # Reset booking manager state after successful deletion
                 return True
             return False
 
-        except Exception as e:
-            print(f"Database error: {e}")
-            if conn:
-                conn.close()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}", file=sys.stderr)  #the user is told by the reply, this is for the operator
             return False
 
     def format_bookings_list(self, bookings): #used to format the list to show all the bookings
@@ -334,108 +356,35 @@ class BookingManager: #handles the booking details and states
         return formatted
 
     def parse_input(self, user_input):  #input validation with the error handling
-        date_pattern = r"\b(?:\d{1,2}[/-]\d{1,2}[/-]\d{2,4}|\d{4}[/-]\d{1,2}[/-]\d{1,2})\b"
-        time_pattern = r"\b(?:\d{1,2}[:.]\d{2}(?:\s*[apAP][mM])?|\d{1,2}[ \t]?[apAP][mM])\b"
-        people_pattern = r"(?i)\b(\d+)\s*(?:people|persons|guests|seats|tables?)\b"
-
-        # Extract date
-        date_match = re.search(date_pattern, user_input)
-        if date_match:
-            raw_date = date_match.group()
-            try:
-                # Split the date into components
-                day, month, year = map(int, re.split(r'[/-]', raw_date))
-                if not (1 <= month <= 12):
-                    print(f"{chatbot_name}: Invalid month. Please provide a month between 1 and 12.")
-                    return False
-                if not (1 <= day <= 31):
-                    print(f"{chatbot_name}: Invalid day. Please provide a day between 1 and 31.")
-                    return False
-
-
-                # Parse the validated date
-                parsed_date = datetime(year, month, day).date()
-                current_date = datetime.now().date()
-                max_future_date = current_date + timedelta(days=90)
-
-                if parsed_date < current_date:
-                    print(f"{chatbot_name}: Sorry, bookings must be for a future date after {current_date}. Please try again.")
-                    return False
-                if parsed_date > max_future_date:
-                    print(f"{chatbot_name}: Sorry, bookings can only be made up to 3 months in advance. Please try again.")
-                    return False
-                self.data["date"] = parsed_date
-                self.data["booking_active"] = True
-                return True
-            except ValueError:
-                pass
-
-        # Extract time
-        time_match = re.search(time_pattern, user_input)
-        if time_match:
-            try:
-                parsed_time = parser.parse(time_match.group(), fuzzy=True).time()
-                restaurant_open = parser.parse(self.restaurant_hours['open']).time()
-                restaurant_close = parser.parse(self.restaurant_hours['close']).time()
-
-                if parsed_time < restaurant_open or parsed_time > restaurant_close:
-                    print(
-                        f"{chatbot_name}: Sorry, our restaurant is only open between {self.restaurant_hours['open']} and {self.restaurant_hours['close']}. Provide a time within our open hours")
-                    return False
-
-                self.data["time"] = parsed_time
-                self.data["booking_active"] = True
-                return True
-            except ValueError:
-                pass
-
-        # Extract people
-        people_match = re.search(people_pattern, user_input)
-        if people_match:
-            try:
-                num_people = int(people_match.group(1))
-                if num_people <= 0:
-                    print(
-                        f"{chatbot_name}: Please provide a valid number of people. The number of people must be positive, try again")
-                    return False
-                if num_people > self.max_party_size:
-                    print(
-                        f"{chatbot_name}: Sorry, we can only accommodate parties up to {self.max_party_size} people. For larger groups, please contact us directly.")
-                    return False
-
-                self.data["people"] = num_people
-                self.data["booking_active"] = True
-                return True
-            except ValueError:
-                pass
+        """
+        Fill every booking detail found in the message, telling the user about each one that is not allowed.
+        Returns the names of the details filled, False when the message only held details that were refused
+        and None when it held none.
+        """
+        with span('parse_slots', 'restaurantBooking'):
+            values, errors = extract_slots(user_input)
+        for error in errors:
+            self.say(error)
+        if values:
+            self.data.update(values)
+            self.data["booking_active"] = True
+            return list(values)
+        if errors:
+            return False
 
         if user_input.isdigit():
-            print(f"{chatbot_name}: please provide the number of people in the correct format. eg 5 people")
+            self.say(f"please provide the number of people in the correct format. eg 5 people")
             return False
 
-        dietary_r = ['halal', 'vegan', 'vegetarian', 'kosher', 'pescatarian', 'none']
-        if user_input.lower() in dietary_r:
-            self.data["dietary"] = user_input.lower()
-            self.data["booking_active"] = True
-            return True
-
         return None
 
 
 #code used to create model
 
-def create_restaurant_model():
-    data_path = 'Datasets/RestaurantBooking.csv'
+def create_restaurant_model(): #saves the lemmatised booking phrases and their response templates for the fused index
     df = pd.read_csv(data_path)
-    df['question'] = df['phrase'].apply(lemmatisation)
-    tfidf_vectorizer = TfidfVectorizer(analyzer='word', ngram_range=(1, 4))
-    transform = tfidf_vectorizer.fit_transform(df['question']).toarray()
-    dump((tfidf_vectorizer, transform), 'models/restaurant_model.joblib')
-
-
-def load_restaurant_model():
-    restaurant_vectorizer, restaurant_transform = load('models/restaurant_model.joblib')
-    return restaurant_vectorizer, restaurant_transform
+    phrases = df['phrase'].apply(lemmatisation_full)
+    dump((list(phrases), list(df['Response'])), model_path)
 
 
 def detect_intent(user_input): #rule basde to detect cancel and modify
@@ -451,13 +400,51 @@ def detect_intent(user_input): #rule basde to detect cancel and modify
     return "book"
 
 
-def restaurant_response(query, booking_manager,chat_name):
-    from IdentityManagement import name
-    global chatbot_name
-    chatbot_name = chat_name
+def ask_for_name(booking_manager, query, prompt):
+    #the request is kept until the user gives their name on the next turn
+    booking_manager.data["awaiting_name"] = query
+    return prompt
+
+
+def give_name(query, session):
+    #the reply to ask_for_name, remembers the name and carries on with the request that needed it
+    booking_manager = session.booking_manager
+    request = booking_manager.data["awaiting_name"]
+    input_name_c = extract_name(query.strip())
+    if not input_name_c:
+        return "Please tell me your name so I can continue."
+    booking_manager.data["awaiting_name"] = None
+    starting = detect_intent(request) == "book" and not booking_manager.is_active()  #set_name makes it active
+    booking_manager.set_name(input_name_c)
+    identity_management(input_name_c, session)
+    if starting:
+        return start_booking(booking_manager, input_name_c)
+    return restaurant_response(request, session)
+
+
+def start_booking(booking_manager, name):  #starts a new booking, first showing the user any bookings they have
+    existing_bookings = booking_manager.get_customer_bookings(name)
+    if existing_bookings:
+        return f"I see you already have {len(existing_bookings)} booking(s):\n" + \
+            booking_manager.format_bookings_list(existing_bookings) + \
+            "\nWould you like to make another booking? (yes/no)"
+
+    booking_manager.set_name(name)
+    if booking_manager.has_pending_booking():
+        return
+
+    return f"Thank you {name}! What date (DD/MM/YYYY) would you like to make your booking for?"
+
+
+def restaurant_response(query, session, analysis=None):
+    booking_manager = session.booking_manager
+    name = session.name
     if not booking_manager.data["name"]:
         booking_manager.data["name"] = name
 
+    if booking_manager.data.get("awaiting_name"):
+        return give_name(query, session)
+
 
     if booking_manager.data.get("modifying_booking") and booking_manager.data.get("awaiting_modification_field"):
         if query.lower() in ['date', 'time', 'people', 'dietary']:
@@ -484,7 +471,16 @@ def restaurant_response(query, booking_manager,chat_name):
                 new_value = booking_manager.data["dietary"]
 
             if new_value:
-                booking_manager.update_booking(booking_manager.data["booking_id"], field, new_value)
+                booking_id = booking_manager.data["booking_id"]
+                if field != 'dietary':  #the booking only moves if a table is free at the new date, time or size
+                    moved = booking_manager.moved_booking(booking_id, field, new_value)
+                    unavailable = moved and booking_manager.unavailable_message(*moved, booking_id=booking_id)
+                    if unavailable:
+                        booking_manager.data[field] = None
+                        return unavailable
+                if not booking_manager.update_booking(booking_id, field, new_value):
+                    booking_manager.data[field] = None
+                    return f"Sorry, I couldn't change the {field} of that booking. Please enter another {field}:"
                 updated_booking = booking_manager.get_booking_details(booking_manager.data["booking_id"])
                 booking_manager.reset()
                 return (f"Booking updated successfully! New details:\n"
@@ -498,12 +494,8 @@ def restaurant_response(query, booking_manager,chat_name):
         # Handle modification requests
     if detect_intent(query) == "change":
         if not booking_manager.data["name"]:  # First time asking for name
-            print(f"{chatbot_name}: First, please tell me your name so I can find your bookings.")
-            input_name = input("You: ").strip()
-            input_name_c = extract_name(input_name)
-            name = input_name_c
-            booking_manager.set_name(input_name_c)
-            identity_management(input_name_c)
+            return ask_for_name(booking_manager, query,
+                                "First, please tell me your name so I can find your bookings.")
 
         bookings = booking_manager.get_customer_bookings(name)
         if not bookings:
@@ -584,12 +576,8 @@ def restaurant_response(query, booking_manager,chat_name):
     # Handle initial cancellation request
     if detect_intent(query) == "cancel":
         if not name:
-            print(f"{chatbot_name}: First, please tell me your name so I can find your bookings.")
-            input_name = input("You: ").strip()
-            input_name_c = extract_name(input_name)
-            name = input_name_c
-            booking_manager.set_name(input_name_c)
-            identity_management(input_name_c)
+            return ask_for_name(booking_manager, query,
+                                "First, please tell me your name so I can find your bookings.")
 
         bookings = booking_manager.get_customer_bookings(name)
         if not bookings:
@@ -599,49 +587,34 @@ def restaurant_response(query, booking_manager,chat_name):
         return booking_manager.format_bookings_list(
             bookings) + "\nPlease enter the number of the booking you'd like to cancel."
 
-    restaurant_vectorizer, restaurant_transform = load_restaurant_model()
-    processed_query = lemmatisation(query)
-    query_transform = restaurant_vectorizer.transform([processed_query]).toarray()
-
-    cos_sim = 1 - pairwise_distances(query_transform, restaurant_transform, metric='cosine').flatten()
-    max_sim = cos_sim.max()
-    matching_indices = np.where(cos_sim == max_sim)[0]
+    max_sim, matching_indices, responses = analyse(query, analysis).match('restaurant_booking')
     success = booking_manager.parse_input(query)
+    #every detail given, possibly in this one message, so the booking goes straight to confirmation
+    details_complete = all(booking_manager.data[detail] for detail in ('date', 'time', 'people', 'dietary'))
 
     # Handle new booking initialization
-    if not booking_manager.is_active():
+    if not booking_manager.is_active() or (details_complete and not booking_manager.data["name"]):
         if not name:
-            print(f"{chatbot_name}: First, please tell me your name so I can make a booking.")
-            input_name = input("You: ").strip()
-            input_name_c = extract_name(input_name)
-            name = input_name_c
-            booking_manager.set_name(input_name_c)
-            identity_management(input_name_c)
-
-        existing_bookings = booking_manager.get_customer_bookings(name)
-        if existing_bookings:
-            return f"I see you already have {len(existing_bookings)} booking(s):\n" + \
-                booking_manager.format_bookings_list(existing_bookings) + \
-                "\nWould you like to make another booking? (yes/no)"
-
-        booking_manager.set_name(name)
-        if booking_manager.has_pending_booking():
-            return
-
-        return f"Thank you {name}! What date (DD/MM/YYYY) would you like to make your booking for?"
-
-    if max_sim >= 0.7:
-        df = pd.read_csv('Datasets/RestaurantBooking.csv')
-        response = df['Response'].iloc[random.choice(matching_indices)]
-        response = response.replace("[date]", str(booking_manager.data["date"])) \
-            .replace("[time]", str(booking_manager.data["time"])) \
-            .replace("[name]", str(booking_manager.data["name"])) \
-            .replace("[people]", str(booking_manager.data["people"]))
+            return ask_for_name(booking_manager, query, "First, please tell me your name so I can make a booking.")
+        return start_booking(booking_manager, name)
+
+    #a message giving several details is answered with what was noted, not a template asking for one of them
+    if max_sim >= THRESHOLD and not details_complete and not (success and len(success) > 1):
+        response = responses[random.choice(matching_indices)]
+        for detail in ('date', 'time', 'name', 'people'):
+            response = response.replace(f"[{detail}]", booking_manager.shown(detail))
         return response
 
     if not success:
         return None
 
+    if booking_manager.data["date"] and booking_manager.data["time"] and booking_manager.data["people"]:
+        unavailable = booking_manager.unavailable_message(
+            booking_manager.data["date"], booking_manager.data["time"], booking_manager.data["people"])
+        if unavailable:
+            booking_manager.data["time"] = None
+            return unavailable
+
     #processing regular booking states
     if booking_manager.data["date"] and booking_manager.data["time"] and booking_manager.data["people"] and \
             booking_manager.data["dietary"]:
@@ -649,23 +622,69 @@ def restaurant_response(query, booking_manager,chat_name):
             return f"Perfect! Your booking has been saved. Details:\n" + \
                 f"Name: {booking_manager.data['name']}\n" + \
                 f"Date: {booking_manager.data['date']}\n" + \
-                f"Time: {booking_manager.data['time']}\n" + \
+                f"Time: {booking_manager.shown('time')}\n" + \
                 f"Number of people: {booking_manager.data['people']}\n" + \
                 f"dietary: {booking_manager.data['dietary']}"
+        #the last table went to another conversation after the time was checked
+        booking_manager.data["confirmed"] = False
+        unavailable = booking_manager.unavailable_message(
+            booking_manager.data["date"], booking_manager.data["time"], booking_manager.data["people"])
+        booking_manager.data["time"] = None
+        return unavailable or "Sorry, that time has just been taken. What other time would you like?"
+
+    if len(success) > 1:  #several details in one message, ask for the first one still missing
+        if "date" in success and not booking_manager.data["time"] and \
+                not booking_manager.availability.has_free_slot(booking_manager.data["date"]):
+            fully_booked = booking_manager.data["date"]
+            booking_manager.data["date"] = None
+            return f"Sorry, we are fully booked on {fully_booked}. What other date would you like?"
+        noted = ', '.join(f"{booking_manager.data[detail]} people" if detail == 'people' else
+                          f"{detail} {booking_manager.shown(detail)}" for detail in success)
+        missing = booking_manager.get_next_missing_info()
+        return f"Great! I have noted the {noted}. Next, I need {missing[0].lower()}{missing[1:]}."
 
     if booking_manager.data["date"] and not booking_manager.data["time"] and not booking_manager.data["people"]:
-        return f"Great! I will check availability on {booking_manager.data['date']}. Next, I need the time you would like to make the booking?"
+        if not booking_manager.availability.has_free_slot(booking_manager.data["date"]):
+            fully_booked = booking_manager.data["date"]
+            booking_manager.data["date"] = None
+            return f"Sorry, we are fully booked on {fully_booked}. What other date would you like?"
+        return f"Great! We have tables free on {booking_manager.data['date']}. Next, I need the time you would like to make the booking?"
 
     if booking_manager.data["time"] and not booking_manager.data["people"]:
-        return f"Great! I will check availability at {booking_manager.data['time']}. How many people should I make the booking for?"
+        booking_date, booking_time = booking_manager.data["date"], booking_manager.data["time"]
+        if not booking_date:
+            return (f"Great! I have noted the time {booking_time.strftime('%H:%M')}. "
+                    "How many people should I make the booking for?")
+        if not booking_manager.availability.is_available(booking_date, booking_time, 1):
+            booking_manager.data["time"] = None
+            free_times = booking_manager.availability.nearest_free(booking_date, booking_time, 1)
+            if not free_times:
+                booking_manager.data["date"] = None
+                return f"Sorry, we are fully booked on {booking_date}. What other date would you like?"
+            return (f"Sorry, we are fully booked at {booking_time.strftime('%H:%M')} on {booking_date}. "
+                    f"The nearest free times are {', '.join(t.strftime('%H:%M') for t in free_times)}. "
+                    "Which time would you like?")
+        return (f"Great! We have tables free at {booking_time.strftime('%H:%M')} on {booking_date}. "
+                "How many people should I make the booking for?")
 
     if booking_manager.data["people"] and not booking_manager.data["dietary"]:
         dietary_preference = booking_manager.get_dietary_preference(booking_manager.data['name'])
         preference_hint = f" I notice you usually prefer {dietary_preference}." if dietary_preference else ""
-        return (f"Great! I will check availability for {booking_manager.data['people']} people.\n"
+        #date, time and people were checked above, so a table is free when all three are known
+        if booking_manager.data["date"] and booking_manager.data["time"]:
+            available = (f"We have a table for {booking_manager.data['people']} people at "
+                         f"{booking_manager.data['time'].strftime('%H:%M')} on {booking_manager.data['date']}")
+        else:
+            available = f"I have noted {booking_manager.data['people']} people"
+        return (f"Great! {available}.\n"
                 f" Lastly type 'Halal','vegan','vegetarian','kosher','pescatarian' if you have any of the dietary requirements or 'none' if you don't.\n"
                 f"\t {preference_hint} ")
     if booking_manager.data["dietary"] and not booking_manager.data["date"]:
         return f"great I will save that. What date would you like the booking on?"
 
     return None
+
+
+def restaurant_from_match(max_sim, matching_indices, responses):
+    #the response template for the best matching phrase without touching any booking, None below the threshold
+    return responses[random.choice(matching_indices)] if max_sim >= THRESHOLD else None
@@ -0,0 +1,241 @@
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from instrumentation import timed
+
+#shared retrieval engine used by every intent module
+#the TF-IDF matrix is kept as a sparse CSR matrix with L2 normalised rows,
+#so the cosine similarity of a query against every row is a single sparse dot product
+#with hashing features there is no vocabulary to fit, so a large corpus can be indexed a chunk at a time.
+#the term counts of each chunk are spooled to temporary files and the weighted matrix is memory mapped from them,
+#so only the document frequencies and the row offsets of the corpus are held in memory
+
+spool_rows = 65536  #rows weighted and normalised at a time when the spooled matrix is finished
+score_cells = 1 << 24  #similarities in one dense score block, 64 MB of float32 however many rows the index has
+
+
+def score_batch_size(n_rows, limit):  #texts to score together, at most limit, so the block stays in score_cells
+    return max(1, min(limit, score_cells // max(n_rows, 1)))
+
+
+class SparseIndex:
+    def __init__(self, hashing=False, **vectorizer_params):
+        vectorizer_params.setdefault('dtype', np.float32)  #half the memory of float64 and enough precision
+        if hashing:
+            #raw term counts of hashed features, the idf weights are worked out by fit_chunks
+            self.vectorizer = HashingVectorizer(alternate_sign=False, norm=None, **vectorizer_params)
+        else:
+            self.vectorizer = TfidfVectorizer(**vectorizer_params)
+        self.hashing = hashing
+        self.idf = None  #idf of every hashed feature, TfidfVectorizer keeps its own
+        self.spool = None  #(data file, indices file, row lengths, document frequency) while counts are added
+        self.matrix = None
+        self.inverted = None  #built the first time top_k is used
+
+    def fit(self, texts):
+        if self.hashing:
+            return self.fit_chunks([texts])
+        matrix = self.vectorizer.fit_transform(texts).tocsr()
+        self.matrix = normalize(matrix, norm='l2', copy=False)
+        self.inverted = None
+        return self
+
+    def fit_chunks(self, chunks):
+        """
+        Build the index from an iterable of lists of texts, only one chunk of text is in memory at a time.
+        Needs hashing features, the term counts are kept as sparse rows and weighted once every chunk is read.
+        """
+        if not self.hashing:
+            raise ValueError("fit_chunks needs an index built with hashing=True")
+        return self.fit_counts(self.count(texts) for texts in chunks)
+
+    def count(self, texts):  #hashed term counts of the texts as sparse rows
+        return self.vectorizer.transform(texts).tocsr()
+
+    def fit_counts(self, counts):
+        #builds the index from an iterable of term count blocks made by count(), weighted once all are read
+        self.start_counts()
+        for block in counts:
+            self.add_counts(block)
+        return self.finish_counts()
+
+    def start_counts(self):  #the same as fit_counts a block at a time, for blocks made in another loop
+        self.spool = (tempfile.TemporaryFile(), tempfile.TemporaryFile(), [],
+                      np.zeros(self.vectorizer.n_features, dtype=np.int64))
+
+    def add_counts(self, block):  #writes the block to the spool files, only its row lengths are kept
+        data_file, indices_file, row_lengths, document_frequency = self.spool
+        document_frequency += np.bincount(block.indices, minlength=self.vectorizer.n_features)
+        data_file.write(block.data.astype(self.vectorizer.dtype, copy=False).tobytes())
+        indices_file.write(block.indices.astype(np.int32, copy=False).tobytes())
+        row_lengths.append(np.diff(block.indptr))
+
+    def finish_counts(self):
+        data_file, indices_file, row_lengths, document_frequency = self.spool
+        self.spool = None
+        with data_file, indices_file:
+            lengths = np.concatenate(row_lengths) if row_lengths else np.zeros(0, dtype=np.int64)
+            indptr = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=indptr[1:])
+            index_dtype = np.int32 if indptr[-1] <= np.iinfo(np.int32).max else np.int64
+            data = spooled(data_file, self.vectorizer.dtype, indptr[-1])
+            indices = spooled(indices_file, np.int32, indptr[-1])
+        if index_dtype is np.int64:  #scipy wants both index arrays of one type, copied a block at a time
+            with tempfile.TemporaryFile() as wide_file:
+                for start in range(0, len(indices), spool_rows * 64):
+                    wide_file.write(indices[start:start + spool_rows * 64].astype(np.int64).tobytes())
+                indices = spooled(wide_file, np.int64, len(indices))
+        #the same smoothed idf as TfidfVectorizer
+        idf = np.log((1 + len(lengths)) / (1 + document_frequency)) + 1
+        idf[document_frequency == 0] = 0  #features no row has are dropped from queries, as a vocabulary would
+        self.idf = idf.astype(self.vectorizer.dtype)
+        for first in range(0, len(lengths), spool_rows):  #idf weights and L2 normalisation in place
+            last = min(first + spool_rows, len(lengths))
+            values = data[indptr[first]:indptr[last]]
+            values *= self.idf[indices[indptr[first]:indptr[last]]]
+            rows = np.repeat(np.arange(last - first), lengths[first:last])
+            norms = np.sqrt(np.bincount(rows, weights=values.astype(np.float64) ** 2, minlength=last - first))
+            norms[norms == 0] = 1
+            values /= norms[rows].astype(values.dtype)
+        self.matrix = sp.csr_matrix((data, indices, indptr.astype(index_dtype)),
+                                    shape=(len(lengths), self.vectorizer.n_features), copy=False)
+        self.inverted = None
+        return self
+
+    def weight(self, counts):  #applies the idf of the hashed features to term counts
+        weighted = (counts @ sp.diags(self.idf)).tocsr()
+        weighted.eliminate_zeros()
+        return weighted
+
+    @timed('vectorise', 'retrieval')
+    def transform(self, texts):  #vectorises the queries with the same L2 normalisation as the rows
+        vectors = self.vectorizer.transform(texts)
+        if self.hashing:
+            vectors = self.weight(vectors)
+        return normalize(vectors, norm='l2', copy=False)
+
+    @timed('score_all', 'retrieval')
+    def score_batch(self, texts):
+        """
+        Cosine similarity between each text and every row of the index in one sparse matrix product.
+        Returns a dense array with one row per text and one column per index row, score_batch_size texts
+        keep it under score_cells.
+        """
+        queries = self.transform(texts)
+        return np.asarray(queries.dot(self.matrix.T).todense())
+
+    def scores(self, text):  #cosine similarity of a single text against every row
+        return self.score_batch([text])[0]
+
+    def best_match(self, text):
+        #returns the highest similarity and the indices of all the rows that have it
+        return self.best_matches([text])[0]
+
+    def top_k(self, text, k, row_range=None):
+        """
+        The k most similar rows to the text and any tied with the k-th, optionally only rows in [first, last).
+        Only rows sharing a term with the text are scored, returns (rows, scores) highest first.
+        """
+        if self.inverted is None:
+            self.inverted = InvertedIndex(self.matrix)
+        return self.inverted.top_k(self.transform([text]), k, row_range)
+
+    def best_matches(self, texts, batch_size=1024):
+        """
+        best_match for many texts, scored batch_size texts at a time so the dense score block stays small.
+        Returns a list of (highest similarity, indices of the rows that have it).
+        """
+        texts = list(texts)
+        batch_size = score_batch_size(self.matrix.shape[0], batch_size)
+        matches = []
+        for start in range(0, len(texts), batch_size):
+            cos_sim = self.score_batch(texts[start:start + batch_size])
+            for row in cos_sim:
+                if row.size == 0:
+                    matches.append((0.0, np.array([], dtype=int)))
+                    continue
+                max_sim = row.max()
+                matches.append((max_sim, np.flatnonzero(row == max_sim)))
+        return matches
+
+
+def spooled(f, dtype, length):
+    #the array written to a spool file, memory mapped so the pages stay on disk until they are read
+    if not length:
+        return np.zeros(0, dtype=dtype)
+    f.flush()
+    return np.memmap(f, dtype=dtype, mode='r+', shape=(int(length),))
+
+
+class InvertedIndex:
+    """
+    Term -> postings view of an L2 normalised TF-IDF matrix for top-k retrieval at corpus scale.
+    Only rows that share a term with the query are scored, and max-score pruning stops new rows being
+    added once the terms left cannot lift an unseen row into the top k.
+    """
+    def __init__(self, matrix):
+        postings = matrix.tocsc()
+        postings.sort_indices()
+        self.postings = postings  #column t holds the rows containing term t and their weights
+        self.n_rows = matrix.shape[0]
+        self.max_weights = np.asarray(postings.max(axis=0).todense()).ravel()  #highest weight of every term
+
+    def term_postings(self, term, row_range=None):
+        start, stop = self.postings.indptr[term], self.postings.indptr[term + 1]
+        rows = self.postings.indices[start:stop]
+        weights = self.postings.data[start:stop]
+        if row_range is not None:  #the rows are sorted so a slice of them is two binary searches
+            low, high = np.searchsorted(rows, row_range)
+            rows, weights = rows[low:high], weights[low:high]
+        return rows, weights
+
+    @timed('score', 'retrieval')
+    def top_k(self, query, k, row_range=None):
+        """
+        The k best rows for a 1 x terms query vector, optionally only rows in [first, last).
+        Every row tied with the k-th best is kept too, so the caller chooses among all ties as a full scoring would.
+        Returns (rows, scores) sorted by score, highest first.
+        """
+        terms, query_weights = query.indices, query.data
+        if terms.size == 0 or k <= 0:
+            return np.array([], dtype=int), np.array([], dtype=np.float32)
+
+        upper_bounds = query_weights * self.max_weights[terms]
+        order = np.argsort(-upper_bounds)  #rare, high weight terms first so the threshold rises quickly
+        remaining = float(upper_bounds.sum())  #the most an unseen row could still score
+        candidate_rows = np.array([], dtype=np.int64)
+        candidate_scores = np.array([], dtype=np.float64)
+        threshold = 0.0  #score of the k-th best candidate so far
+
+        for position in order:
+            rows, weights = self.term_postings(terms[position], row_range)
+            contributions = weights * query_weights[position]
+            if candidate_rows.size < k or remaining >= threshold:
+                #an unseen row could still make the top k, so every row of the postings is a candidate
+                merged_rows = np.concatenate([candidate_rows, rows])
+                merged_scores = np.concatenate([candidate_scores, contributions])
+                candidate_rows, inverse = np.unique(merged_rows, return_inverse=True)
+                candidate_scores = np.bincount(inverse, weights=merged_scores)
+            elif rows.size:
+                #only the existing candidates can make the top k, they are looked up in the postings
+                found = np.searchsorted(rows, candidate_rows)
+                found = np.minimum(found, rows.size - 1)
+                hit = rows[found] == candidate_rows
+                candidate_scores[hit] += contributions[found[hit]]
+            #clamped, rounding would otherwise leave it just below zero and prune rows tied with the k-th best
+            remaining = max(remaining - float(upper_bounds[position]), 0.0)
+
+            if candidate_rows.size > k:
+                threshold = np.partition(candidate_scores, -k)[-k]
+                keep = candidate_scores + remaining >= threshold  #rows that cannot reach the top k are dropped
+                candidate_rows, candidate_scores = candidate_rows[keep], candidate_scores[keep]
+
+        if candidate_rows.size > k:
+            keep = candidate_scores >= np.partition(candidate_scores, -k)[-k]
+            candidate_rows, candidate_scores = candidate_rows[keep], candidate_scores[keep]
+        best = np.lexsort((candidate_rows, -candidate_scores))
+        return candidate_rows[best], candidate_scores[best].astype(np.float32)
@@ -0,0 +1,53 @@
+import csv
+import sys
+
+#checks the routing against known phrases, run from this directory after changing a dataset, the vectorizers
+#or a threshold
+#  python routing_check.py
+#every phrase in Datasets/routing_phrases.csv has to go to the intent listed with it and score at least the
+#threshold of that module, so the module answers it. Exits with 1 if any phrase does not
+
+routing_phrases_path = 'Datasets/routing_phrases.csv'
+flow_intents = {'restaurant_booking'}  #answered by the booking flow, their threshold only picks a response template
+
+
+def misrouted(path=routing_phrases_path):  #a message for every phrase that is not routed and answered as listed
+    from main import fused_modules
+    from turn_analysis import analyse
+    thresholds = {intent: threshold for intent, _, threshold in fused_modules}
+    found = []
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            analysis = analyse(row['phrase'])
+            intent, similarity = analysis.route()
+            if intent != row['intent']:
+                found.append(f"{row['phrase']!r} went to {intent} ({similarity:.3f}), expected {row['intent']}")
+                continue
+            similarity = analysis.match(intent)[0]
+            if intent not in flow_intents and similarity < thresholds[intent]:
+                found.append(f"{row['phrase']!r} scores {similarity:.3f} in {intent}, "
+                             f"below its threshold {thresholds[intent]}")
+    return found
+
+
+def main(argv=None):
+    from main import model_specs
+    from model_cache import build_models
+    from model_registry import registry
+    from nltk_resources import ensure_nltk_resources, MissingNLTKResourceError
+    path = (argv if argv is not None else sys.argv[1:]) or [routing_phrases_path]
+    try:
+        ensure_nltk_resources()
+    except MissingNLTKResourceError as e:
+        sys.exit(str(e))
+    build_models(model_specs)
+    registry.load_all()
+    found = misrouted(path[0])
+    if found:
+        print("Misrouted phrases:\n  " + '\n  '.join(found))
+        sys.exit(1)
+    print("Every phrase is routed as expected")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import threading
+import time
+import uuid
+
+from restaurantBooking import BookingManager
+
+#the state of one conversation, passed to every handler instead of being kept in module globals
+#so a single process with its models loaded can hold many conversations at once
+
+
+class Session:
+    def __init__(self, session_id=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.chatbot_name = "Chatbot"  #name of the chatbot by default
+        self.name = ""  #the user's current name
+        self.pname = ""  #the user's previous name
+        self.booking_manager = BookingManager()
+        self.previous_intent = None
+        self.naming_chatbot = False  #is the next message the chatbot's new name
+        self.switch_request = None  #(message, intent, previous intent) waiting for a yes/no to switch tasks
+
+        #discovery context
+        self.section = None  #the area in which the response should be
+        self.asked = False  #has the user been asked general or current
+        self.intent_history = [None, None]  #keeps track of current intent and previous one
+
+        self.last_active = time.monotonic()
+
+    def touch(self):  #marks the session as used now
+        self.last_active = time.monotonic()
+
+
+class SessionStore:
+    """
+    Holds the open sessions of a process by id.
+    Sessions are made the first time their id is seen and can be dropped after a period without messages.
+    """
+    def __init__(self, idle_timeout=30 * 60):
+        self.idle_timeout = idle_timeout  #seconds without a message before a session is dropped
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, session_id=None):  #returns the session with the id, a new one if there is none
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = Session(session_id)
+                self.sessions[session.session_id] = session
+            session.touch()
+            return session
+
+    def remove(self, session_id):
+        with self.lock:
+            self.sessions.pop(session_id, None)
+
+    def expire(self):  #drops the idle sessions and returns how many were dropped
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [session_id for session_id, session in self.sessions.items() if session.last_active < cutoff]
+            for session_id in idle:
+                del self.sessions[session_id]
+        return len(idle)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
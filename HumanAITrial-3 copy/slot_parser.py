@@ -0,0 +1,131 @@
+import re
+from datetime import date, time
+
+from booking_validation import check_date, check_day_month, check_people, check_time, dietary_options
+
+#finds the booking details in a message and turns them straight into values
+#the patterns are compiled once and the matched groups are converted directly, without dateutil, so this is
+#cheap enough to run on every turn. Every pattern needs a digit, so a message without one is answered at once.
+#extract_slots reads every detail of a booking from one message, so "table for 4 people at 7pm on 12/12/2026,
+#vegan" fills the whole booking in a single turn
+
+date_re = re.compile(r"\b(?:(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})|(\d{4})[/-](\d{1,2})[/-](\d{1,2}))\b")
+time_re = re.compile(r"\b(?:(\d{1,2})[:.](\d{2})(?:\s*([ap])m)?|(\d{1,2})[ \t]?([ap])m)\b", re.IGNORECASE)
+people_re = re.compile(r"\b(\d+)\s*(?:people|persons|guests|seats|tables?)\b", re.IGNORECASE)
+number_re = re.compile(r"\b\d+\b")
+digit_re = re.compile(r"\d")
+#'none' only counts as the whole message, inside a sentence it rarely means no dietary requirement
+dietary_re = re.compile(r"\b(" + '|'.join(option for option in dietary_options if option != 'none') + r")\b",
+                        re.IGNORECASE)
+
+no_slots = {'date': None, 'time': None, 'people': None, 'number': None}
+
+
+def date_parts(text):  #(day, month, year) of the first date in the text, None if there is none
+    match = date_re.search(text)
+    if not match:
+        return None
+    day, month, year, long_year, long_month, long_day = match.groups()
+    if long_year:  #written year first
+        day, month, year = long_day, long_month, long_year
+    year = int(year)
+    if year < 100:  #12/12/26
+        year += 2000
+    return int(day), int(month), year
+
+
+def parse_date(text):  #the first date in the text, None if there is none or it is not a real date
+    parts = date_parts(text)
+    if parts is None:
+        return None
+    day, month, year = parts
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+def parse_time(text):  #the first time in the text as 7pm, 7 pm, 19:00, 19.00 or 7:30pm, None if there is none
+    match = time_re.search(text)
+    if not match:
+        return None
+    hour, minute, meridiem, short_hour, short_meridiem = match.groups()
+    hour = int(hour or short_hour)
+    minute = int(minute or 0)
+    meridiem = (meridiem or short_meridiem or '').lower()
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'p' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return time(hour, minute)
+
+
+def parse_people(text):  #the party size in '4 people', '4 guests'..., None if there is none
+    match = people_re.search(text)
+    return int(match.group(1)) if match else None
+
+
+def find_slots(text):
+    """
+    Find the booking details mentioned in a message without validating them against a booking.
+    Returns a dict with the 'date', 'time', 'people' and plain 'number', None where nothing was found.
+    """
+    if not digit_re.search(text):
+        return dict(no_slots)
+    number = number_re.search(text)
+    return {'date': parse_date(text), 'time': parse_time(text), 'people': parse_people(text),
+            'number': int(number.group()) if number else None}
+
+
+def parse_dietary(text):  #the dietary requirement named in the text, None if there is none
+    if text.strip().lower() == 'none':
+        return 'none'
+    match = dietary_re.search(text)
+    return match.group(1).lower() if match else None
+
+
+def extract_slots(text, today=None):
+    """
+    Read every booking detail in a message and check each one on its own against the booking rules.
+    Returns (accepted values by slot, error messages), so the details that are fine are kept and the user
+    hears about everything wrong with the message in one reply.
+    """
+    values, errors = {}, []
+    if digit_re.search(text):
+        parts = date_parts(text)
+        if parts:
+            day, month, year = parts
+            error = check_day_month(day, month)
+            if not error:
+                try:
+                    booking_date = date(year, month, day)
+                    error = check_date(booking_date, today)
+                except ValueError:
+                    error = "That date does not exist. Please check the day and month."
+            if error:
+                errors.append(error)
+            else:
+                values['date'] = booking_date
+
+        booking_time = parse_time(text)
+        if booking_time is not None:
+            error = check_time(booking_time)
+            if error:
+                errors.append(error)
+            else:
+                values['time'] = booking_time
+
+        people = parse_people(text)
+        if people is not None:
+            error = check_people(people)
+            if error:
+                errors.append(error)
+            else:
+                values['people'] = people
+
+    dietary = parse_dietary(text)
+    if dietary is not None:
+        values['dietary'] = dietary
+    return values, errors
@@ -0,0 +1,95 @@
+from functools import cached_property
+
+from fused_index import load_fused_model
+from model_registry import registry
+from preprocessing import analyse_text, normalise_text, analyze_sentiment, mood_messages
+from slot_parser import find_slots
+
+#the NLP analysis of one message, built once per turn and passed to every handler
+#each piece of work is done the first time it is asked for and then kept, so no turn does it twice
+
+top_k = 10  #best rows of the fused index kept per turn, the response is chosen from the ties among them
+
+#registered here rather than in main, so every module analysing a message can be used on its own
+registry.register('fused', load_fused_model)
+
+
+class TurnAnalysis:
+    def __init__(self, text):
+        self.text = text
+        self.intent_rows = {}  #intent -> best rows of that intent, for intents the overall best rows miss
+        self.intent_route_rows = {}  #the same from the route index
+
+    @cached_property
+    def pipeline(self):  #tokens, tags and lemmas of every word in the message
+        return analyse_text(normalise_text(self.text))
+
+    @cached_property
+    def tokens(self):
+        return self.pipeline[0]
+
+    @cached_property
+    def tags(self):
+        return self.pipeline[1]
+
+    @cached_property
+    def lemmas(self):  #the text matched against the fused index
+        return self.pipeline[2]
+
+    @cached_property
+    def top(self):  #best rows of the fused index and their similarity, looked up once per turn
+        return registry.get('fused').top_rows(self.lemmas, top_k)
+
+    @cached_property
+    def route_top(self):  #the same from the route index
+        return registry.get('fused').top_route_rows(self.lemmas, top_k)
+
+    def route(self):  #the intent of the best matching phrase and its similarity
+        return registry.get('fused').route_rows(*self.route_top)
+
+    def best_in_intent(self, intent, route=False):
+        #best_in_rows of one intent, from the rows already found this turn unless none of them belong to it
+        fused_index = registry.get('fused')
+        top, intent_rows = (self.route_top, self.intent_route_rows) if route else (self.top, self.intent_rows)
+        found = fused_index.best_in_rows(intent, *top)
+        if found is None:
+            if intent not in intent_rows:
+                lookup = fused_index.top_route_rows if route else fused_index.top_rows
+                intent_rows[intent] = lookup(self.lemmas, top_k, intent)
+            found = fused_index.best_in_rows(intent, *intent_rows[intent])
+        return found
+
+    def match(self, intent):
+        """
+        (similarity, indices of the best rows, payloads) of one intent.
+        The similarity comes from the route index, which the module thresholds are tuned for, and the rows
+        from the n-gram index, which tells apart phrases sharing the same words.
+        """
+        routed = self.best_in_intent(intent, route=True)
+        best = self.best_in_intent(intent)
+        if routed is None or best is None:  #nothing in the intent shares a word with the message
+            return 0.0, [], registry.get('fused').payloads[intent]
+        return routed[0], best[1], best[2]
+
+    @cached_property
+    def slots(self):  #the date, time, number of people and plain number mentioned in the message
+        return find_slots(self.text)
+
+    @cached_property
+    def has_booking_details(self):  #does the message contain a date, time or number
+        return any(value is not None for value in self.slots.values())
+
+    @cached_property
+    def sentiment(self):
+        return analyze_sentiment(self.text)
+
+    @cached_property
+    def mood(self):  #emoji added to the response for the sentiment of the message
+        return mood_messages.get(self.sentiment, "")
+
+
+def analyse(query, analysis=None):
+    #returns the analysis of the query, reusing the one for this turn if the caller already has it
+    if analysis is not None and analysis.text == query:
+        return analysis
+    return TurnAnalysis(query)
@@ -0,0 +1,175 @@
+import collections
+import multiprocessing
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import Future
+
+from booking_journal import booking_journal
+from main import chat_turn, start_conversation
+from session import SessionStore
+
+#pre-forked pool of worker processes for CPU bound turns
+#the supervisor forks the workers once the models and NLTK data are loaded, so every worker starts warm and
+#shares the loaded pages with the supervisor. Every session is kept by one worker, chosen from its id,
+#so its state never moves between processes. The supervisor counts what it sends and gets back from each
+#worker, which gives the queue depth and throughput of every worker
+
+throughput_window = 60  #seconds of finished turns used for the turns per second of a worker
+
+
+class WorkerStopped(Exception):
+    pass
+
+
+def worker_main(requests, results):
+    #the loop of one worker process, it keeps the sessions routed to it
+    sessions = SessionStore()
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, kind, session_id, message = request
+        if kind == 'end':
+            sessions.remove(session_id)
+            continue
+        start = time.perf_counter()
+        replies, error = None, None
+        try:
+            if kind == 'start':
+                replies = start_conversation(sessions.get(session_id))
+            else:
+                replies = chat_turn(sessions.get(session_id), message)
+        except Exception as e:  #reported back to the caller, the worker keeps going
+            error = repr(e)
+        results.put((request_id, replies, error, time.perf_counter() - start))
+    if booking_journal is not None:  #the worker exits without running atexit, so it writes its journal now
+        booking_journal.close()
+
+
+class WorkerStats:
+    def __init__(self):
+        self.sent = 0
+        self.finished = 0
+        self.busy_seconds = 0.0
+        self.recent = collections.deque()  #finish times of the turns in the throughput window
+
+    def finish(self, seconds):
+        now = time.monotonic()
+        self.finished += 1
+        self.busy_seconds += seconds
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - throughput_window:
+            self.recent.popleft()
+
+
+class WorkerPool:
+    """
+    N forked worker processes answering turns, with the same interface as chat_server.LocalTurns.
+    Create it after the models are loaded and before any thread is started, the workers are forked here.
+    """
+    def __init__(self, processes, idle_timeout=30 * 60):
+        context = multiprocessing.get_context('fork')  #the workers inherit the loaded models
+        self.idle_timeout = idle_timeout
+        self.results = context.Queue()
+        self.requests = []
+        self.workers = []
+        for _ in range(processes):
+            requests = context.Queue()
+            worker = context.Process(target=worker_main, args=(requests, self.results), daemon=True)
+            worker.start()
+            self.requests.append(requests)
+            self.workers.append(worker)
+        self.stats = [WorkerStats() for _ in self.workers]
+        self.sessions = {}  #session id -> time of its last message
+        self.waiting = {}  #request id -> (worker index, future)
+        self.lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_results, name='pool-results', daemon=True)
+        self.reader.start()
+
+    def worker_for(self, session_id):  #a stable hash, so a session always goes to the same worker
+        return zlib.crc32(session_id.encode()) % len(self.workers)
+
+    def submit(self, kind, session_id, message=None):
+        index = self.worker_for(session_id)
+        future = Future()
+        if not self.workers[index].is_alive():
+            future.set_exception(WorkerStopped(f"worker {index} has stopped"))
+            return future
+        request_id = uuid.uuid4().hex
+        with self.lock:
+            self.waiting[request_id] = (index, future)
+            self.stats[index].sent += 1
+        self.requests[index].put((request_id, kind, session_id, message))
+        return future
+
+    def read_results(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+            request_id, replies, error, seconds = result
+            with self.lock:
+                index, future = self.waiting.pop(request_id)
+                self.stats[index].finish(seconds)
+            if error is None:
+                future.set_result(replies)
+            else:
+                future.set_exception(RuntimeError(error))
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def start(self, session_id=None):
+        #starts a conversation on its worker, returns the session id and a future of the opening lines
+        session_id = session_id or uuid.uuid4().hex
+        self.sessions[session_id] = time.monotonic()
+        return session_id, self.submit('start', session_id)
+
+    def turn(self, session_id, message):  #the future gives the reply lines
+        self.sessions[session_id] = time.monotonic()
+        return self.submit('turn', session_id, message)
+
+    def end(self, session_id):
+        if self.sessions.pop(session_id, None) is not None:
+            self.requests[self.worker_for(session_id)].put((None, 'end', session_id, None))
+
+    def expire(self):  #ends the idle sessions and fails the turns of any worker that has died
+        cutoff = time.monotonic() - self.idle_timeout
+        for session_id in [session_id for session_id, last in self.sessions.items() if last < cutoff]:
+            self.end(session_id)
+        with self.lock:
+            for request_id, (index, future) in list(self.waiting.items()):
+                if not self.workers[index].is_alive():
+                    del self.waiting[request_id]
+                    self.stats[index].sent -= 1
+                    future.set_exception(WorkerStopped(f"worker {index} has stopped"))
+
+    def report(self):
+        #per worker: process id, turns waiting or running, turns finished and turns per second
+        now = time.monotonic()
+        report = []
+        with self.lock:
+            for index, (worker, stats) in enumerate(zip(self.workers, self.stats)):
+                recent = sum(1 for finished in stats.recent if finished >= now - throughput_window)
+                report.append({
+                    'worker': index,
+                    'pid': worker.pid,
+                    'alive': worker.is_alive(),
+                    'queue_depth': stats.sent - stats.finished,
+                    'turns': stats.finished,
+                    'turns_per_second': recent / throughput_window,
+                    'busy_seconds': round(stats.busy_seconds, 3)
+                })
+        return report
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.results.put(None)